@@ -9,24 +9,25 @@ fetches the PaymentIntent from Stripe, and displays the result.
 import os
 import json
 import stripe
-from http.server import BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import unquote_plus
 
 
 stripe.api_key = os.environ.get("STRIPE_SECRET_KEY", "")
 
 
-def build_html(title, status_emoji, status_text, details):
-    """Build a clean status page."""
-    return f"""<!DOCTYPE html>
+# Static page fragments, encoded once at import. Only the title, emoji,
+# status text and details slots vary per request, so each response is a
+# single bytes join instead of re-formatting the whole page.
+_PRELUDE = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{title}</title>
+    <title>""".encode()
+_HEAD = """</title>
     <style>
-        * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-        body {{
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        body {
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
             background: #f6f9fc;
             display: flex;
@@ -34,8 +35,8 @@ def build_html(title, status_emoji, status_text, details):
             align-items: center;
             min-height: 100vh;
             padding: 20px;
-        }}
-        .card {{
+        }
+        .card {
             background: white;
             border-radius: 12px;
             box-shadow: 0 4px 24px rgba(0,0,0,0.08);
@@ -43,10 +44,10 @@ def build_html(title, status_emoji, status_text, details):
             max-width: 480px;
             width: 100%;
             text-align: center;
-        }}
-        .emoji {{ font-size: 64px; margin-bottom: 16px; }}
-        .status {{ font-size: 24px; font-weight: 600; color: #1a1a2e; margin-bottom: 8px; }}
-        .details {{
+        }
+        .emoji { font-size: 64px; margin-bottom: 16px; }
+        .status { font-size: 24px; font-weight: 600; color: #1a1a2e; margin-bottom: 8px; }
+        .details {
             font-size: 14px;
             color: #6b7c93;
             line-height: 1.8;
@@ -56,98 +57,158 @@ def build_html(title, status_emoji, status_text, details):
             padding: 16px;
             border-radius: 8px;
             font-family: 'SF Mono', Monaco, monospace;
-        }}
-        .details span {{ color: #1a1a2e; font-weight: 500; }}
-        .badge {{
+        }
+        .details span { color: #1a1a2e; font-weight: 500; }
+        .badge {
             display: inline-block;
             padding: 4px 12px;
             border-radius: 20px;
             font-size: 13px;
             font-weight: 500;
             margin-top: 12px;
-        }}
-        .badge-success {{ background: #d4edda; color: #155724; }}
-        .badge-fail {{ background: #f8d7da; color: #721c24; }}
-        .badge-pending {{ background: #fff3cd; color: #856404; }}
-        .footer {{
+        }
+        .badge-success { background: #d4edda; color: #155724; }
+        .badge-fail { background: #f8d7da; color: #721c24; }
+        .badge-pending { background: #fff3cd; color: #856404; }
+        .footer {
             margin-top: 32px;
             font-size: 12px;
             color: #adb5bd;
-        }}
+        }
     </style>
 </head>
 <body>
     <div class="card">
-        <div class="emoji">{status_emoji}</div>
-        <div class="status">{status_text}</div>
-        {details}
+        <div class="emoji">""".encode()
+_MID1 = """</div>
+        <div class="status">""".encode()
+_MID2 = """</div>
+        """.encode()
+_POSTLUDE = """
         <div class="footer">Stripe TAM Portfolio — Return URL Server</div>
     </div>
 </body>
-</html>"""
-
-
-class handler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        query = parse_qs(urlparse(self.path).query)
-
-        pi_id = query.get("payment_intent", [None])[0]
-        redirect_status = query.get("redirect_status", ["unknown"])[0]
-
-        # No params — show landing page
-        if not pi_id:
-            html = build_html(
-                "Stripe Return URL",
-                "🔗",
-                "Return URL Server Active",
-                '<p style="text-align:center;color:#6b7c93;margin-top:16px;">'
-                "This endpoint receives Stripe payment redirects.<br>"
-                "Add this URL as your <code>return_url</code> in PaymentIntents."
-                "</p>",
-            )
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html")
-            self.end_headers()
-            self.wfile.write(html.encode())
-            return
-
-        # Fetch PaymentIntent from Stripe
-        try:
-            pi = stripe.PaymentIntent.retrieve(pi_id)
-            amount = f"{pi.currency.upper()} {pi.amount / 100:,.2f}"
-            status = pi.status
-
-            if status == "succeeded":
-                emoji, text = "✅", "Payment Succeeded"
-                badge = '<span class="badge badge-success">succeeded</span>'
-            elif status == "requires_payment_method":
-                emoji, text = "❌", "Payment Failed"
-                badge = '<span class="badge badge-fail">requires_payment_method</span>'
-            else:
-                emoji, text = "⏳", "Payment Processing"
-                badge = f'<span class="badge badge-pending">{status}</span>'
-
-            details = f"""
-            <div>{badge}</div>
+</html>""".encode()
+
+
+# Payment-result details block, split around its dynamic values
+_DETAILS_BADGE = """
+            <div>""".encode()
+_DETAILS_PI = """</div>
             <div class="details">
-                <span>Payment Intent:</span> {pi.id}<br>
-                <span>Amount:</span> {amount}<br>
-                <span>Status:</span> {status}<br>
-                <span>Redirect:</span> {redirect_status}<br>
-                <span>Description:</span> {pi.description or "—"}
-            </div>"""
-
-            html = build_html("Payment Result", emoji, text, details)
-
-        except stripe.error.StripeError as e:
-            html = build_html(
-                "Error",
-                "⚠️",
-                "Could not fetch payment",
-                f'<p style="text-align:center;color:#e74c3c;margin-top:16px;">{str(e)}</p>',
-            )
-
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.end_headers()
-        self.wfile.write(html.encode())
+                <span>Payment Intent:</span> """.encode()
+_DETAILS_AMOUNT = """<br>
+                <span>Amount:</span> """.encode()
+_DETAILS_STATUS = """<br>
+                <span>Status:</span> """.encode()
+_DETAILS_REDIRECT = """<br>
+                <span>Redirect:</span> """.encode()
+_DETAILS_DESCRIPTION = """<br>
+                <span>Description:</span> """.encode()
+_DETAILS_CLOSE = """
+            </div>""".encode()
+
+
+def build_html(title, status_emoji, status_text, details):
+    """Build a clean status page as UTF-8 bytes. `details` is pre-encoded."""
+    return b"".join([
+        _PRELUDE, title.encode(),
+        _HEAD, status_emoji.encode(),
+        _MID1, status_text.encode(),
+        _MID2, details,
+        _POSTLUDE,
+    ])
+
+
+# The no-params landing page never changes, so render and encode it once
+# per cold start instead of on every hit.
+LANDING_HTML_BYTES = build_html(
+    "Stripe Return URL",
+    "🔗",
+    "Return URL Server Active",
+    '<p style="text-align:center;color:#6b7c93;margin-top:16px;">'
+    "This endpoint receives Stripe payment redirects.<br>"
+    "Add this URL as your <code>return_url</code> in PaymentIntents."
+    "</p>".encode(),
+)
+
+
+def parse_return_query(query):
+    """
+    Pull payment_intent and redirect_status out of a query string in one
+    pass, stopping once both are found. Matches parse_qs for these keys:
+    first occurrence wins and blank values are ignored.
+    """
+    pi_id = None
+    redirect_status = None
+
+    for pair in query.split("&"):
+        key, _, value = pair.partition("=")
+        if not value:
+            continue
+        if key == "payment_intent" and pi_id is None:
+            pi_id = unquote_plus(value)
+        elif key == "redirect_status" and redirect_status is None:
+            redirect_status = unquote_plus(value)
+        if pi_id is not None and redirect_status is not None:
+            break
+
+    return pi_id, redirect_status or "unknown"
+
+
+def render_page(query):
+    """Render the response body for a return-URL query string."""
+    pi_id, redirect_status = parse_return_query(query)
+
+    # No params — show landing page
+    if not pi_id:
+        return LANDING_HTML_BYTES
+
+    # Fetch PaymentIntent from Stripe
+    try:
+        pi = stripe.PaymentIntent.retrieve(pi_id)
+        amount = f"{pi.currency.upper()} {pi.amount / 100:,.2f}"
+        status = pi.status
+
+        if status == "succeeded":
+            emoji, text = "✅", "Payment Succeeded"
+            badge = '<span class="badge badge-success">succeeded</span>'
+        elif status == "requires_payment_method":
+            emoji, text = "❌", "Payment Failed"
+            badge = '<span class="badge badge-fail">requires_payment_method</span>'
+        else:
+            emoji, text = "⏳", "Payment Processing"
+            badge = f'<span class="badge badge-pending">{status}</span>'
+
+        details = b"".join([
+            _DETAILS_BADGE, badge.encode(),
+            _DETAILS_PI, pi.id.encode(),
+            _DETAILS_AMOUNT, amount.encode(),
+            _DETAILS_STATUS, status.encode(),
+            _DETAILS_REDIRECT, redirect_status.encode(),
+            _DETAILS_DESCRIPTION, (pi.description or "—").encode(),
+            _DETAILS_CLOSE,
+        ])
+
+        return build_html("Payment Result", emoji, text, details)
+
+    except stripe.error.StripeError as e:
+        return build_html(
+            "Error",
+            "⚠️",
+            "Could not fetch payment",
+            f'<p style="text-align:center;color:#e74c3c;margin-top:16px;">{str(e)}</p>'.encode(),
+        )
+
+
+def app(environ, start_response):
+    """
+    WSGI entry point — Vercel's Python runtime serves a module-level `app`
+    directly, so there is no BaseHTTPRequestHandler per-request setup.
+    """
+    html = render_page(environ.get("QUERY_STRING", ""))
+    start_response("200 OK", [
+        ("Content-Type", "text/html"),
+        ("Content-Length", str(len(html))),
+    ])
+    return [html]
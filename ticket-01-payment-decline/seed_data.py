@@ -4,12 +4,21 @@ Uses Stripe's built-in test payment method IDs (no raw card numbers needed).
 """
 
 import os
+import threading
+import requests
 import stripe
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# The seeding threads share one keep-alive connection pool.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(session=_session, verify_ssl_certs=True)
+
 # Stripe's built-in test payment method IDs
 TEST_CASES = [
     ("pm_card_visa",                "Visa success",        "success"),
@@ -24,6 +33,17 @@ TEST_CASES = [
     ("pm_card_chargeDeclinedIncorrectCvc",      "Incorrect CVC",      "fail"),
 ]
 
+# Each create is an independent network round-trip, so fan them out.
+# Keep MAX_WORKERS <= pool_maxsize so every thread gets a pooled connection.
+MAX_WORKERS = 8
+_print_lock = threading.Lock()
+
+
+def log(line):
+    with _print_lock:
+        print(line)
+
+
 def create_payment(pm_id, description):
     try:
         intent = stripe.PaymentIntent.create(
@@ -33,13 +53,13 @@ def create_payment(pm_id, description):
             confirm=True,
             return_url="https://example.com",
         )
-        print(f"  ✓ {description} — {intent.status}")
+        log(f"  ✓ {description} — {intent.status}")
     except stripe.error.CardError as e:
-        print(f"  ✗ {description} — {e.error.decline_code or e.error.code}")
+        log(f"  ✗ {description} — {e.error.decline_code or e.error.code}")
     except Exception as e:
-        print(f"  ! {description} — unexpected error: {e}")
+        log(f"  ! {description} — unexpected error: {e}")
 
 print("Seeding test PaymentIntents...\n")
-for pm_id, desc, _ in TEST_CASES:
-    create_payment(pm_id, desc)
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    list(executor.map(lambda case: create_payment(case[0], case[1]), TEST_CASES))
 print("\nDone. Now run solution.py to see the diagnostic report.")
@@ -5,12 +5,22 @@ from recent PaymentIntents.
 """
 
 import os
+import sys
+import requests
 import stripe
 from collections import Counter
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Pin the API version so response shapes (and payload sizes) stay stable.
+stripe.api_version = "2024-06-20"
+
+# Every page of the PaymentIntent listing reuses one keep-alive connection.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(session=_session, verify_ssl_certs=True)
 
 
 ISSUER_DECLINES = {
@@ -30,93 +40,116 @@ STRIPE_BLOCKS = {
 }
 
 
-def fetch_failed_payment_intents(limit=100):
-    """Fetch recent failed PaymentIntents from the Stripe API."""
-    results = []
-    payment_intents = stripe.PaymentIntent.list(limit=limit)
+def fetch_failed_payment_intents():
+    """
+    Stream failed PaymentIntents, filtered server-side by the Search API
+    so successful payments never cross the wire.
+    """
+    return stripe.PaymentIntent.search(
+        query="status:'requires_payment_method'",
+        limit=100,
+    ).auto_paging_iter()
 
-    for pi in payment_intents.auto_paging_iter():
-        if pi.status == "requires_payment_method" and pi.last_payment_error:
-            results.append(pi)
-        if len(results) >= limit:
-            break
 
-    return results
+def count_payment_intents():
+    """Total PaymentIntents on the account, without downloading any of them."""
+    result = stripe.PaymentIntent.search(
+        query="created>0",
+        limit=1,
+        expand=["total_count"],
+    )
+    return result.total_count
 
 
 def analyse_declines(failed_intents):
-    """Group failures by decline code and classify root cause."""
-    decline_codes = []
+    """
+    Stream failed PaymentIntents once, counting them by decline code.
+    Each object is dropped as soon as it is counted, so memory stays flat
+    however long the account history is.
+    """
+    counter = Counter()
 
     for pi in failed_intents:
         error = pi.last_payment_error
-        code = error.decline_code or error.code or "unknown"
-        decline_codes.append(code)
+        if error:
+            counter[error.decline_code or error.code or "unknown"] += 1
 
-    return Counter(decline_codes)
+    return counter
 
 
-def print_diagnostic_report(total_fetched, failed_intents, counter):
-    """Print a clean summary a TAM can share directly with the merchant."""
-    total_failed = len(failed_intents)
+def print_diagnostic_report(total_fetched, total_failed, counter):
+    """
+    Print a clean summary a TAM can share directly with the merchant.
+    The report is collected line by line and written to stdout once.
+    """
     failure_rate = (total_failed / total_fetched * 100) if total_fetched else 0
-
-    print("=" * 55)
-    print("  STRIPE DECLINE DIAGNOSTIC — TechGear GmbH")
-    print("=" * 55)
-    print(f"  Payment intents analysed : {total_fetched}")
-    print(f"  Failed                   : {total_failed}")
-    print(f"  Failure rate             : {failure_rate:.1f}%")
-    print("-" * 55)
-    print("  BREAKDOWN BY DECLINE CODE")
-    print("-" * 55)
-
-    for code, count in counter.most_common():
+    ranked = counter.most_common()
+
+    out = [
+        "=" * 55,
+        "  STRIPE DECLINE DIAGNOSTIC — TechGear GmbH",
+        "=" * 55,
+        f"  Payment intents analysed : {total_fetched}",
+        f"  Failed                   : {total_failed}",
+        f"  Failure rate             : {failure_rate:.1f}%",
+        "-" * 55,
+        "  BREAKDOWN BY DECLINE CODE",
+        "-" * 55,
+    ]
+
+    for code, count in ranked:
         pct = count / total_failed * 100
         category = "Issuer" if code in ISSUER_DECLINES else \
                    "Stripe/Radar" if code in STRIPE_BLOCKS else "Other"
         explanation = ISSUER_DECLINES.get(code) or \
                       STRIPE_BLOCKS.get(code) or "No standard explanation."
-        print(f"  [{category}] {code} — {count}x ({pct:.1f}%)")
-        print(f"    → {explanation}")
+        out.append(f"  [{category}] {code} — {count}x ({pct:.1f}%)")
+        out.append(f"    → {explanation}")
 
-    print("=" * 55)
-    print("  RECOMMENDATION")
-    print("-" * 55)
+    out += [
+        "=" * 55,
+        "  RECOMMENDATION",
+        "-" * 55,
+    ]
 
-    top_code = counter.most_common(1)[0][0] if counter else None
+    top_code = ranked[0][0] if ranked else None
 
     if top_code in ISSUER_DECLINES:
-        print("  Dominant cause: issuer-side declines.")
-        print("  → No integration fix needed on merchant side.")
-        print("  → Advise merchant to review checkout UX (card retry,")
-        print("    clear error messages, offer alternative methods")
-        print("    such as SEPA Direct Debit or Klarna for DE market).")
+        out += [
+            "  Dominant cause: issuer-side declines.",
+            "  → No integration fix needed on merchant side.",
+            "  → Advise merchant to review checkout UX (card retry,",
+            "    clear error messages, offer alternative methods",
+            "    such as SEPA Direct Debit or Klarna for DE market).",
+        ]
     elif top_code in STRIPE_BLOCKS:
-        print("  Dominant cause: Stripe/Radar blocks.")
-        print("  → Review Radar rules in the Dashboard.")
-        print("  → Check if a recent rule change is over-blocking.")
+        out += [
+            "  Dominant cause: Stripe/Radar blocks.",
+            "  → Review Radar rules in the Dashboard.",
+            "  → Check if a recent rule change is over-blocking.",
+        ]
     else:
-        print("  Mixed decline pattern — manual review recommended.")
-        print("  → Share full breakdown with merchant and Stripe support.")
+        out += [
+            "  Mixed decline pattern — manual review recommended.",
+            "  → Share full breakdown with merchant and Stripe support.",
+        ]
 
-    print("=" * 55)
+    out.append("=" * 55)
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 def main():
     print("Fetching failed PaymentIntents...\n")
-    all_intents = list(stripe.PaymentIntent.list(limit=100).auto_paging_iter())
-    failed = [pi for pi in all_intents
-              if pi.status == "requires_payment_method" and pi.last_payment_error]
+    counter = analyse_declines(fetch_failed_payment_intents())
+    total_failed = sum(counter.values())
 
-    if not failed:
+    if not total_failed:
         print("No failed PaymentIntents found in test data.")
         print("Tip: use the Stripe CLI to trigger test declines:")
         print("  stripe trigger payment_intent.payment_failed")
         return
 
-    counter = analyse_declines(failed)
-    print_diagnostic_report(len(all_intents), failed, counter)
+    print_diagnostic_report(count_payment_intents(), total_failed, counter)
 
 
 if __name__ == "__main__":
@@ -4,18 +4,71 @@ Secure Flask webhook receiver with signature verification
 and missed event recovery via the Stripe Events API.
 """
 
+import hashlib
+import hmac
+import json
 import os
+import time
+import requests
 import stripe
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 
+# Missed-event recovery pages through Events on one keep-alive connection.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(session=_session, verify_ssl_certs=True)
+
+# Encoded once — the secret is constant for the life of the process
+WEBHOOK_SECRET_BYTES = (WEBHOOK_SECRET or "").encode()
+# Same default tolerance as stripe.Webhook.construct_event
+WEBHOOK_TOLERANCE = 300
+
 app = Flask(__name__)
 
 
+# ─── SIGNATURE VERIFICATION ───────────────────────────────────────────────────
+
+def verify_signature(payload, sig_header, secret=WEBHOOK_SECRET_BYTES, tolerance=WEBHOOK_TOLERANCE):
+    """
+    Verify a Stripe-Signature header against the raw request body.
+    `secret` is the endpoint secret as bytes. Same checks as
+    stripe.Webhook.construct_event, but a stale or missing timestamp is
+    rejected before any HMAC work is done — replayed requests cost a
+    string split, not a SHA-256.
+    """
+    # Fail closed: with no endpoint secret configured, an empty HMAC key would
+    # let anyone forge a valid signature
+    if not secret:
+        return False
+
+    timestamp = None
+    signatures = []
+    for item in (sig_header or "").split(","):
+        key, _, value = item.partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+
+    # isascii() too: isdigit() alone accepts digits like '²' that int() rejects
+    if not (timestamp and timestamp.isascii() and timestamp.isdigit()) or not signatures:
+        return False
+    if abs(time.time() - int(timestamp)) > tolerance:
+        return False
+
+    signed_payload = timestamp.encode() + b"." + payload
+    expected = hmac.new(secret, signed_payload, hashlib.sha256).hexdigest()
+    # Several v1 signatures are sent while a secret is being rolled
+    return any(hmac.compare_digest(expected, sig) for sig in signatures)
+
+
 # ─── WEBHOOK RECEIVER ─────────────────────────────────────────────────────────
 
 @app.route("/webhook", methods=["POST"])
@@ -25,14 +78,12 @@ def webhook():
 
     # Step 1 — Verify the signature
     # Without this, anyone can send fake events to your endpoint.
-    try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, WEBHOOK_SECRET
-        )
-    except stripe.error.SignatureVerificationError:
+    if not verify_signature(payload, sig_header):
         print("⚠️  Invalid signature — request rejected.")
         return jsonify({"error": "Invalid signature"}), 400
 
+    event = json.loads(payload)
+
     # Step 2 — Route to the correct handler
     event_type = event["type"]
     data = event["data"]["object"]
@@ -53,44 +104,89 @@ def webhook():
     return jsonify({"status": "ok"}), 200
 
 
+# Log templates are bound once at import; handlers only fill the slots.
+_SUCCEEDED_LOG = (
+    "✓ Payment succeeded: {id}\n"
+    "  Amount: {amount:.2f} {currency}\n"
+    "  → Fulfil order for customer: {customer}"
+).format
+_FAILED_LOG = (
+    "✗ Payment failed: {id}\n"
+    "  Reason: {reason}\n"
+    "  → Notify customer and prompt retry"
+).format
+_DISPUTE_LOG = (
+    "⚠️  Dispute opened on charge: {id}\n"
+    "  Amount: {amount:.2f}\n"
+    "  → Gather evidence immediately — deadline is 7-21 days"
+).format
+
+CURRENCY_LABELS = {c: c.upper() for c in ("eur", "usd", "gbp", "chf", "sek", "nok", "dkk")}
+
+
 def handle_payment_succeeded(payment_intent):
-    print(f"✓ Payment succeeded: {payment_intent['id']}")
-    print(f"  Amount: {payment_intent['amount'] / 100:.2f} {payment_intent['currency'].upper()}")
-    print(f"  → Fulfil order for customer: {payment_intent.get('customer', 'guest')}")
+    currency = payment_intent["currency"]
+    print(_SUCCEEDED_LOG(
+        id=payment_intent["id"],
+        amount=payment_intent["amount"] / 100,
+        currency=CURRENCY_LABELS.get(currency) or currency.upper(),
+        customer=payment_intent.get("customer", "guest"),
+    ))
 
 
 def handle_payment_failed(payment_intent):
     error = payment_intent.get("last_payment_error", {})
-    print(f"✗ Payment failed: {payment_intent['id']}")
-    print(f"  Reason: {error.get('decline_code') or error.get('code', 'unknown')}")
-    print(f"  → Notify customer and prompt retry")
+    print(_FAILED_LOG(
+        id=payment_intent["id"],
+        reason=error.get("decline_code") or error.get("code", "unknown"),
+    ))
 
 
 def handle_dispute_created(charge):
-    print(f"⚠️  Dispute opened on charge: {charge['id']}")
-    print(f"  Amount: {charge['amount'] / 100:.2f}")
-    print(f"  → Gather evidence immediately — deadline is 7-21 days")
+    print(_DISPUTE_LOG(id=charge["id"], amount=charge["amount"] / 100))
 
 
 # ─── MISSED EVENT RECOVERY ────────────────────────────────────────────────────
 
+RECOVERY_EVENT_TYPES = ["payment_intent.succeeded", "payment_intent.payment_failed"]
+RECOVERY_WORKERS = 4
+
+
+def _fetch_event_window(start, end):
+    """Page through every recoverable event created in [start, end)."""
+    events = stripe.Event.list(
+        created={"gte": start, "lt": end},
+        types=RECOVERY_EVENT_TYPES,
+        limit=100,
+    )
+    return list(events.auto_paging_iter())
+
+
 def fetch_missed_events(hours_ago=72):
     """
     Fetch events from the last N hours via the Stripe Events API.
     Use this to recover events your server missed while it was down.
+
+    List cursors can't be known before a page is fetched, so the window is
+    split into RECOVERY_WORKERS time slices instead; each slice pages on
+    its own thread over the shared connection pool.
     """
-    import time
     since = int(time.time()) - (hours_ago * 3600)
+    until = int(time.time()) + 1  # exclusive bound, so include this second
 
     print(f"\nFetching events from the last {hours_ago} hours...\n")
 
-    events = stripe.Event.list(
-        created={"gte": since},
-        types=["payment_intent.succeeded", "payment_intent.payment_failed"],
-        limit=50,
-    )
+    step = -(-(until - since) // RECOVERY_WORKERS)  # ceiling division
+    windows = [(start, min(start + step, until)) for start in range(since, until, step)]
+
+    with ThreadPoolExecutor(max_workers=RECOVERY_WORKERS) as executor:
+        pages = executor.map(lambda window: _fetch_event_window(*window), windows)
+        events = [event for page in pages for event in page]
+
+    # Newest first, matching the order the Events API returns
+    events.sort(key=lambda event: event["created"], reverse=True)
 
-    for event in events.auto_paging_iter():
+    for event in events:
         obj = event["data"]["object"]
         print(f"  [{event['type']}] {event['id']} — {obj.get('id', 'n/a')}")
 
@@ -5,12 +5,24 @@ TAM Solution: List open disputes, check deadlines, submit evidence via the Strip
 """
 
 import os
+import time
+import requests
 import stripe
 from datetime import datetime, timezone
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Pin the API version so response shapes (and payload sizes) stay stable.
+stripe.api_version = "2024-06-20"
+
+# Dispute listing and evidence updates reuse one keep-alive connection.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(session=_session, verify_ssl_certs=True)
+
+SECONDS_PER_DAY = 86400
 
 
 # =============================================================================
@@ -49,12 +61,15 @@ def list_open_disputes():
         print("  stripe trigger charge.dispute.created")
         return []
 
+    # Read the clock once; deadlines are plain epoch seconds, so days left
+    # is integer math and datetime is only needed to format the date.
+    now = int(time.time())
+
     for dispute in open_disputes:
         deadline_ts = dispute.get("evidence_details", {}).get("due_by")
         if deadline_ts:
-            deadline = datetime.fromtimestamp(deadline_ts, tz=timezone.utc)
-            days_left = (deadline - datetime.now(tz=timezone.utc)).days
-            deadline_str = deadline.strftime("%Y-%m-%d")
+            days_left = (deadline_ts - now) // SECONDS_PER_DAY
+            deadline_str = datetime.fromtimestamp(deadline_ts, tz=timezone.utc).strftime("%Y-%m-%d")
         else:
             deadline_str = "unknown"
             days_left = "?"
@@ -5,11 +5,21 @@ TAM Solution: Radar rule strategy + risk score analysis via the Stripe API.
 """
 
 import os
+import requests
 import stripe
+from bisect import bisect_right
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Pin the API version so response shapes (and payload sizes) stay stable.
+stripe.api_version = "2024-06-20"
+
+# Reuse one keep-alive connection across calls to the Stripe API.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(session=_session, verify_ssl_certs=True)
 
 
 # =============================================================================
@@ -118,6 +128,24 @@ def print_radar_rules():
 # PART 3 — QUERY RADAR RISK SCORES VIA THE API
 # =============================================================================
 
+SCORE_BANDS = ("low (0-39)", "medium (40-74)", "high (75-100)", "no score")
+NO_SCORE = -1  # sentinel for charges Radar didn't score
+BAND_EDGES = (0, 40, 75)  # bisect index: 0 = no score, 1 = low, 2 = medium, 3 = high
+
+
+def bucket_scores(scores):
+    """
+    Count risk scores per band in one pass over plain ints.
+    bisect against the band edges replaces the if/elif chain with a single
+    lookup per score. Returns counts in SCORE_BANDS order.
+    """
+    counts = [0, 0, 0, 0]
+    for score in scores:
+        counts[bisect_right(BAND_EDGES, score)] += 1
+    no_score, low, medium, high = counts
+    return low, medium, high, no_score
+
+
 def analyse_radar_scores(limit=50):
     """
     Pull recent PaymentIntents and extract Radar risk scores.
@@ -127,33 +155,28 @@ def analyse_radar_scores(limit=50):
     print("RADAR RISK SCORE ANALYSIS — recent transactions")
     print("=" * 60)
 
-    intents = stripe.PaymentIntent.list(limit=limit)
-
-    scores = {"low (0-39)": 0, "medium (40-74)": 0, "high (75-100)": 0, "no score": 0}
-    high_risk = []
+    # One page of `limit` intents is the whole sample — no auto-paging.
+    # Expand only the latest charge, which carries the Radar outcome.
+    intents = stripe.PaymentIntent.list(limit=limit, expand=["data.latest_charge"])
 
-    for pi in intents.auto_paging_iter():
-        outcome = pi.get("charges", {}).get("data", [{}])[0].get("outcome", {})
-        score = outcome.get("risk_score")
+    scores = []
+    for pi in intents.data:
+        charge = pi.get("latest_charge") or {}
+        score = (charge.get("outcome") or {}).get("risk_score")
+        scores.append(NO_SCORE if score is None else score)
 
-        if score is None:
-            scores["no score"] += 1
-        elif score >= 75:
-            scores["high (75-100)"] += 1
-            high_risk.append((pi["id"], score, pi["amount"] / 100, pi["currency"].upper()))
-        elif score >= 40:
-            scores["medium (40-74)"] += 1
-        else:
-            scores["low (0-39)"] += 1
+    counts = bucket_scores(scores)
 
-    print(f"\n  Transactions analysed: {limit}")
-    for band, count in scores.items():
+    print(f"\n  Transactions analysed: {len(scores)}")
+    for band, count in zip(SCORE_BANDS, counts):
         print(f"  {band}: {count}")
 
-    if high_risk:
+    if counts[2]:
         print(f"\n  HIGH RISK TRANSACTIONS (score >= 75):")
-        for pid, score, amount, currency in high_risk:
-            print(f"    {pid} — score: {score} — {amount:.2f} {currency}")
+        for pi, score in zip(intents.data, scores):
+            if score >= 75:
+                print(f"    {pi['id']} — score: {score} — "
+                      f"{pi['amount'] / 100:.2f} {pi['currency'].upper()}")
     else:
         print("\n  No high-risk transactions found in this sample.")
 
@@ -5,12 +5,33 @@ TAM Solution: List connected accounts, surface blocking requirements,
 generate onboarding links for incomplete accounts.
 """
 
+import argparse
+import json
+import functools
 import os
+import sqlite3
+import requests
 import stripe
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
-load_dotenv()
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+
+@functools.cache
+def configure_stripe():
+    """
+    Load .env and set up the Stripe client on first API use rather than at
+    import, so the helpers here can be imported without touching disk.
+    """
+    load_dotenv()
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+
+    # Account list pages and AccountLink calls reuse one keep-alive connection.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+    stripe.default_http_client = stripe.RequestsClient(session=session, verify_ssl_certs=True)
+
+
+BAR = "=" * 60
 
 
 # =============================================================================
@@ -35,34 +56,99 @@ stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 # =============================================================================
 
 
-def list_connected_accounts():
+# =============================================================================
+# PART 2 — LOCAL ACCOUNT CACHE
+# =============================================================================
+#
+# Listing every connected account from the API on each run is an O(sellers)
+# scan. Instead, keep a local copy that the account.updated webhook keeps
+# current (see Part 4), and only hit Stripe on an explicit --refresh.
+
+ACCOUNTS_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "connected_accounts.db")
+
+
+def open_accounts_db(path=ACCOUNTS_DB):
+    """Open the local account cache, creating the table on first use."""
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS connected_accounts (
+            id               TEXT PRIMARY KEY,
+            email            TEXT,
+            charges_enabled  INTEGER NOT NULL,
+            payouts_enabled  INTEGER NOT NULL,
+            disabled_reason  TEXT,
+            currently_due    TEXT NOT NULL,
+            updated_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    return db
+
+
+def upsert_account(db, account):
+    """Write one Account object (from the API or a webhook) into the cache."""
+    reqs = account.get("requirements") or {}
+    db.execute(
+        """
+        INSERT OR REPLACE INTO connected_accounts
+            (id, email, charges_enabled, payouts_enabled, disabled_reason, currently_due)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (
+            account["id"],
+            account.get("email"),
+            bool(account.get("charges_enabled", False)),
+            bool(account.get("payouts_enabled", False)),
+            reqs.get("disabled_reason"),
+            json.dumps(list(reqs.get("currently_due") or [])),
+        ),
+    )
+
+
+def handle_account_updated(db, account):
+    """account.updated webhook → refresh this seller's cached row."""
+    with db:
+        upsert_account(db, account)
+
+
+def refresh_connected_accounts(db):
+    """Rebuild the cache from the API — run on demand with --refresh."""
+    configure_stripe()
+    # One transaction: if listing fails part-way, the old cache is kept intact
+    with db:
+        db.execute("DELETE FROM connected_accounts")
+        for account in stripe.Account.list(limit=100).auto_paging_iter():
+            upsert_account(db, account)
+
+
+def list_connected_accounts(db):
     """
     List all connected accounts and their onboarding status.
     Shows what's blocking charges or payouts for each seller.
+    Reads the local cache only — no Stripe API call.
     """
-    print("=" * 60)
+    print(BAR)
     print("CONNECTED ACCOUNT STATUS — Markethub GmbH")
-    print("=" * 60)
+    print(BAR)
 
-    accounts = stripe.Account.list(limit=20)
+    accounts = [dict(row) for row in db.execute("SELECT * FROM connected_accounts ORDER BY id")]
 
-    if not accounts.data:
+    if not accounts:
         print("\nNo connected accounts found.")
         print("Create a test connected account with:")
         print("  See Part 3 below — create_test_connected_account()")
         return []
 
-    for account in accounts.auto_paging_iter():
-        charges_ok = account.get("charges_enabled", False)
-        payouts_ok = account.get("payouts_enabled", False)
-        reqs = account.get("requirements", {})
-        currently_due = reqs.get("currently_due", [])
-        disabled_reason = reqs.get("disabled_reason", None)
+    for account in accounts:
+        charges_ok = bool(account["charges_enabled"])
+        payouts_ok = bool(account["payouts_enabled"])
+        currently_due = json.loads(account["currently_due"])
+        disabled_reason = account["disabled_reason"]
 
         status = "✓ FULLY ACTIVE" if (charges_ok and payouts_ok) else "⚠ RESTRICTED"
 
         print(f"\n  Account ID   : {account['id']}")
-        print(f"  Email        : {account.get('email', 'n/a')}")
+        print(f"  Email        : {account['email'] or 'n/a'}")
         print(f"  Status       : {status}")
         print(f"  Charges      : {'enabled' if charges_ok else 'DISABLED'}")
         print(f"  Payouts      : {'enabled' if payouts_ok else 'DISABLED'}")
@@ -77,7 +163,7 @@ def list_connected_accounts():
         else:
             print(f"  Currently due: none")
 
-    return accounts.data
+    return accounts
 
 
 def create_test_connected_account():
@@ -85,9 +171,10 @@ def create_test_connected_account():
     Create a test Express connected account.
     In production, your platform creates these when a seller signs up.
     """
-    print("\n" + "=" * 60)
+    configure_stripe()
+    print("\n" + BAR)
     print("CREATING TEST CONNECTED ACCOUNT")
-    print("=" * 60)
+    print(BAR)
 
     account = stripe.Account.create(
         type="express",
@@ -115,9 +202,10 @@ def create_onboarding_link(account_id):
     Send this URL to the seller — it opens Stripe's hosted onboarding flow.
     Links expire after a short time, so always generate a new one on demand.
     """
-    print(f"\n{'=' * 60}")
+    configure_stripe()
+    print(f"\n{BAR}")
     print(f"ONBOARDING LINK — {account_id}")
-    print("=" * 60)
+    print(BAR)
 
     link = stripe.AccountLink.create(
         account=account_id,
@@ -138,16 +226,32 @@ def create_onboarding_link(account_id):
 # PART 4 — WEBHOOK: account.updated
 # =============================================================================
 #
-# Add this event to your webhook endpoint to track seller verification:
+# Add this event to your webhook endpoint to track seller verification.
+# Stripe retries deliveries, so gate on the event id first:
+#
+#   CREATE TABLE processed_stripe_events (
+#       event_id     TEXT PRIMARY KEY,
+#       processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+#   );
 #
 #   elif event_type == "account.updated":
-#       account = event["data"]["object"]
-#       if account["charges_enabled"] and account["payouts_enabled"]:
-#           # Seller is fully verified — activate their storefront
-#           activate_seller(account["id"])
-#       elif account["requirements"]["currently_due"]:
-#           # Seller still has outstanding requirements — send reminder
-#           send_reminder_email(account["id"], account["requirements"])
+#       with db:  # one transaction — the event row commits only if the
+#                 # side effects below succeed, so failures get retried
+#           cur = db.execute(
+#               "INSERT OR IGNORE INTO processed_stripe_events(event_id) VALUES (?)",
+#               (event["id"],),
+#           )
+#           if cur.rowcount == 0:
+#               return "", 200  # duplicate delivery — already handled
+#
+#           account = event["data"]["object"]
+#           upsert_account(db, account)  # keep the local cache current
+#           if account["charges_enabled"] and account["payouts_enabled"]:
+#               # Seller is fully verified — activate their storefront
+#               activate_seller(account["id"])
+#           elif account["requirements"]["currently_due"]:
+#               # Seller still has outstanding requirements — send reminder
+#               send_reminder_email(account["id"], account["requirements"])
 #
 # This is what Markethub is missing — without this webhook, they have no
 # way to know when a seller finishes onboarding or what's still blocking them.
@@ -155,9 +259,9 @@ def create_onboarding_link(account_id):
 
 
 def explain_webhook_strategy():
-    print("\n" + "=" * 60)
+    print("\n" + BAR)
     print("WEBHOOK STRATEGY — account.updated")
-    print("=" * 60)
+    print(BAR)
     print("""
   Markethub is not listening to account.updated.
   This is why they have no visibility into seller verification.
@@ -178,15 +282,30 @@ def explain_webhook_strategy():
 
   Never poll the Account object on a schedule.
   Use the webhook — it fires immediately when status changes.
+
+  Stripe retries deliveries, so the same event can arrive twice.
+  Record each event.id in processed_stripe_events in the same
+  transaction as the side effects, and skip ids already recorded.
 """)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--refresh", action="store_true",
+                        help="re-sync the local account cache from the Stripe API")
+    args = parser.parse_args()
+
     print("\nTicket 05 — Connect Platform: Connected Account Onboarding")
     print("Account: Markethub GmbH (Berlin)\n")
 
+    db = open_accounts_db()
+
+    # An empty cache is bootstrapped once; after that the webhook keeps it current
+    if args.refresh or db.execute("SELECT 1 FROM connected_accounts LIMIT 1").fetchone() is None:
+        refresh_connected_accounts(db)
+
     # Step 1: Show all connected accounts and what's blocking them
-    accounts = list_connected_accounts()
+    accounts = list_connected_accounts(db)
 
     # Step 2: If no accounts exist, create a test one
     if not accounts:
@@ -4,12 +4,21 @@ This generates invoices that will fail, so we can test the diagnostic script.
 """
 
 import os
+import threading
+import requests
 import stripe
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# The subscription-creating threads share one keep-alive connection pool.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(timeout=30, session=_session, verify_ssl_certs=True)
+
 # Stripe test payment method IDs that trigger specific failures
 TEST_PAYMENT_METHODS = [
     ("pm_card_chargeDeclined", "Card declined"),
@@ -19,7 +28,38 @@ TEST_PAYMENT_METHODS = [
     ("pm_card_visa", "Visa success (for control)"),
 ]
 
-def create_test_subscription(payment_method_id, description):
+# Each subscription is independent, so create them concurrently — kept
+# low enough to stay well under Stripe's test-mode rate limit.
+MAX_WORKERS = 5
+_print_lock = threading.Lock()
+
+
+def log(line):
+    with _print_lock:
+        print(line)
+
+
+def create_test_price():
+    """Create the one product + monthly price every test subscription shares."""
+    try:
+        product = stripe.Product.create(
+            name="Audiobook Subscription",
+            type="service",
+        )
+        price = stripe.Price.create(
+            product=product.id,
+            unit_amount=999,  # €9.99
+            currency="eur",
+            recurring={"interval": "month", "interval_count": 1},
+        )
+        return price.id
+    except:
+        # If product creation fails, use a fallback
+        print(f"  Note: Using test price. In production, create price in Dashboard.")
+        return "price_1ABC"  # Dummy — won't work but script continues
+
+
+def create_test_subscription(payment_method_id, description, price_id):
     """Create a test subscription with a specific payment method."""
     try:
         # Create customer
@@ -29,26 +69,6 @@ def create_test_subscription(payment_method_id, description):
             invoice_settings={"default_payment_method": payment_method_id},
         )
         
-        # Create a test product and price if needed
-        # For now, we'll use a generic price ID (you may need to create this in Dashboard)
-        # Alternatively, create a simple product+price
-        try:
-            product = stripe.Product.create(
-                name="Audiobook Subscription",
-                type="service",
-            )
-            price = stripe.Price.create(
-                product=product.id,
-                unit_amount=999,  # €9.99
-                currency="eur",
-                recurring={"interval": "month", "interval_count": 1},
-            )
-            price_id = price.id
-        except:
-            # If product creation fails, use a fallback
-            print(f"  Note: Using test price. In production, create price in Dashboard.")
-            price_id = "price_1ABC"  # Dummy — won't work but script continues
-        
         # Create subscription — this will trigger payment
         sub = stripe.Subscription.create(
             customer=customer.id,
@@ -56,21 +76,25 @@ def create_test_subscription(payment_method_id, description):
             payment_behavior="error_if_incomplete",  # Don't retry — just error
         )
         
-        print(f"  ✓ {description:30} → {sub.id}")
+        log(f"  ✓ {description:30} → {sub.id}")
         return sub.id
     
     except stripe.error.CardError as e:
         # Expected for declined cards
-        print(f"  ✗ {description:30} → {e.user_message}")
+        log(f"  ✗ {description:30} → {e.user_message}")
         return None
     except Exception as e:
-        print(f"  ! {description:30} → {str(e)[:50]}")
+        log(f"  ! {description:30} → {str(e)[:50]}")
         return None
 
 print("Creating test subscriptions with various payment failures...\n")
 
-for pm_id, desc in TEST_PAYMENT_METHODS:
-    create_test_subscription(pm_id, desc)
+price_id = create_test_price()
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    list(executor.map(
+        lambda case: create_test_subscription(case[0], case[1], price_id),
+        TEST_PAYMENT_METHODS,
+    ))
 
 print("\nDone. Now run solution.py to see the diagnostic report:")
 print("  python3 ticket-06-subscription-failure/solution.py")
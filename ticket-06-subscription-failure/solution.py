@@ -3,13 +3,30 @@ Ticket 06 — Subscription Invoice Failure & Smart Retry
 Diagnose failed invoices and implement intelligent retry logic.
 """
 
+import functools
 import os
+import sys
+import requests
 import stripe
+from collections import Counter, defaultdict, namedtuple
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
-load_dotenv()
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+
+@functools.cache
+def configure_stripe():
+    """
+    Load .env and set up the Stripe client on first API use rather than at
+    import, so the helpers here can be imported without touching disk.
+    """
+    load_dotenv()
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+
+    # Invoice list/search pages and retries reuse one keep-alive connection.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+    stripe.default_http_client = stripe.RequestsClient(session=session, verify_ssl_certs=True)
 
 # ─── FAILURE CLASSIFICATION ──────────────────────────────────────────────
 
@@ -34,25 +51,51 @@ REQUIRES_ACTION = {
     "authentication_required": "Payment needs authentication",
 }
 
+# Every known code → its category, so classification is a single lookup
+FAILURE_CATEGORY = {
+    **{code: "TEMPORARY" for code in TEMPORARY_FAILURES},
+    **{code: "PERMANENT" for code in PERMANENT_FAILURES},
+    **{code: "ACTION_REQUIRED" for code in REQUIRES_ACTION},
+}
+
+# Order the report's detail sections are printed in
+CATEGORY_ORDER = ("TEMPORARY", "PERMANENT", "ACTION_REQUIRED", "UNKNOWN")
+
+
+# Search can't test a field for presence, and Stripe clears the error once
+# an invoice finalizes — so matching every error type finds exactly the
+# invoices whose finalization failed, in one OR query.
+FINALIZATION_ERROR_QUERY = " OR ".join(
+    f'last_finalization_error_type:"{error_type}"'
+    for error_type in ("api_error", "card_error", "idempotency_error", "invalid_request_error")
+)
+
 
 def fetch_failed_invoices(limit=50):
-    """Fetch recent invoices that failed payment."""
+    """
+    Fetch recent invoices that failed payment.
+
+    Every uncollectible invoice counts. Invoices that failed to finalize
+    are matched server-side via the Search API, so no client-side scan of
+    drafts is needed. Paging stops as soon as `limit` is reached.
+    """
+    configure_stripe()
     failed = []
-    
-    # Check multiple statuses where failures might appear
-    for status in ["draft", "open", "uncollectible"]:
-        invoices = stripe.Invoice.list(status=status, limit=limit)
-        
-        for inv in invoices.auto_paging_iter():
-            # Look for invoices with payment errors
-            if inv.last_finalization_error or status == "uncollectible":
-                failed.append(inv)
-            if len(failed) >= limit:
-                break
-        
+
+    for inv in stripe.Invoice.list(status="uncollectible", limit=limit).auto_paging_iter():
+        failed.append(inv)
+        if len(failed) >= limit:
+            return failed
+
+    finalization_failures = stripe.Invoice.search(
+        query=FINALIZATION_ERROR_QUERY,
+        limit=min(100, limit - len(failed)),
+    )
+    for inv in finalization_failures.auto_paging_iter():
+        failed.append(inv)
         if len(failed) >= limit:
             break
-    
+
     return failed
 
 
@@ -63,15 +106,7 @@ def classify_failure(invoice):
         return "UNKNOWN", "no_error"
     
     code = error.get("code") or error.get("type")
-    
-    if code in TEMPORARY_FAILURES:
-        return "TEMPORARY", code
-    elif code in PERMANENT_FAILURES:
-        return "PERMANENT", code
-    elif code in REQUIRES_ACTION:
-        return "ACTION_REQUIRED", code
-    else:
-        return "UNKNOWN", code
+    return FAILURE_CATEGORY.get(code, "UNKNOWN"), code
 
 
 def should_retry(category, retry_count=0):
@@ -88,6 +123,7 @@ def should_retry(category, retry_count=0):
 
 def retry_invoice(invoice_id):
     """Attempt to retry payment on a failed invoice."""
+    configure_stripe()
     try:
         # pay_invoice attempts to pay an open invoice
         invoice = stripe.Invoice.pay(invoice_id)
@@ -98,124 +134,137 @@ def retry_invoice(invoice_id):
         return False, f"Stripe error: {str(e)}"
 
 
+MockInvoice = namedtuple(
+    "MockInvoice", "id customer_email amount_due currency last_finalization_error"
+)
+
+
+def _mock_invoice(inv_id, email, amount, code, message):
+    return MockInvoice(inv_id, email, amount, "eur", {
+        "code": code,
+        "type": code,
+        "message": message,
+    })
+
+
+# Demo data never changes, so it's built once at import and shared
+DEMO_FAILED_INVOICES = (
+    _mock_invoice("in_demo_001", "maria@audiblebooks.at", 999, "card_declined", "Your card was declined."),
+    _mock_invoice("in_demo_002", "franz@example.com", 999, "insufficient_funds", "Your card has insufficient funds."),
+    _mock_invoice("in_demo_003", "anna@example.at", 999, "expired_card", "Your card has expired."),
+    _mock_invoice("in_demo_004", "peter@example.de", 1299, "try_again", "Your bank is temporarily unavailable."),
+)
+
+
 def get_demo_failed_invoices():
     """Return mock failed invoices for demonstration."""
-    class MockInvoice:
-        def __init__(self, inv_id, email, amount, code, message):
-            self.id = inv_id
-            self.customer_email = email
-            self.amount_due = amount
-            self.currency = "eur"
-            self.last_finalization_error = {
-                "code": code,
-                "type": code,
-                "message": message,
-            }
-    
-    return [
-        MockInvoice("in_demo_001", "maria@audiblebooks.at", 999, "card_declined", "Your card was declined."),
-        MockInvoice("in_demo_002", "franz@example.com", 999, "insufficient_funds", "Your card has insufficient funds."),
-        MockInvoice("in_demo_003", "anna@example.at", 999, "expired_card", "Your card has expired."),
-        MockInvoice("in_demo_004", "peter@example.de", 1299, "try_again", "Your bank is temporarily unavailable."),
-    ]
+    return DEMO_FAILED_INVOICES
 
 
 def print_diagnostic_report(failed_invoices):
-    """Print a comprehensive failure analysis and retry recommendations."""
+    """
+    Print a comprehensive failure analysis and retry recommendations.
+    The report is collected line by line and written to stdout once.
+    """
+    out = []
     
-    print("=" * 70)
-    print("  SUBSCRIPTION INVOICE FAILURE DIAGNOSTIC")
-    print("  Audible Books GmbH (Vienna)")
-    print("=" * 70)
+    out.append("=" * 70)
+    out.append("  SUBSCRIPTION INVOICE FAILURE DIAGNOSTIC")
+    out.append("  Audible Books GmbH (Vienna)")
+    out.append("=" * 70)
     
     if not failed_invoices:
-        print("\n  ✓ No failed invoices found. All subscriptions are healthy.")
-        print("=" * 70)
+        out.append("\n  ✓ No failed invoices found. All subscriptions are healthy.")
+        out.append("=" * 70)
+        sys.stdout.write("\n".join(out) + "\n")
         return
     
-    # Classify all failures
-    breakdown = {
-        "TEMPORARY": [],
-        "PERMANENT": [],
-        "ACTION_REQUIRED": [],
-        "UNKNOWN": [],
-    }
+    # Classify all failures — counts and detail lists built in the same pass
+    counts = Counter()
+    breakdown = defaultdict(list)
     
     for inv in failed_invoices:
         category, code = classify_failure(inv)
+        counts[category] += 1
         breakdown[category].append((inv, code))
     
     # Print summary
     total = len(failed_invoices)
-    print(f"\n  Total failed invoices: {total}")
-    print(f"  • Temporary (can retry):   {len(breakdown['TEMPORARY'])}")
-    print(f"  • Permanent (need action): {len(breakdown['PERMANENT'])}")
-    print(f"  • Action required:         {len(breakdown['ACTION_REQUIRED'])}")
-    print(f"  • Unknown:                 {len(breakdown['UNKNOWN'])}")
+    out.append(f"\n  Total failed invoices: {total}")
+    out.append(f"  • Temporary (can retry):   {counts['TEMPORARY']}")
+    out.append(f"  • Permanent (need action): {counts['PERMANENT']}")
+    out.append(f"  • Action required:         {counts['ACTION_REQUIRED']}")
+    out.append(f"  • Unknown:                 {counts['UNKNOWN']}")
     
     # Print detailed breakdown
-    print("\n" + "=" * 70)
-    print("  BREAKDOWN BY FAILURE REASON")
-    print("=" * 70)
+    out.append("\n" + "=" * 70)
+    out.append("  BREAKDOWN BY FAILURE REASON")
+    out.append("=" * 70)
     
-    for category, invs in breakdown.items():
+    for category in CATEGORY_ORDER:
+        invs = breakdown.get(category)
         if invs:
-            print(f"\n  [{category}]")
+            out.append(f"\n  [{category}]")
             for inv, code in invs:
                 error_msg = inv.last_finalization_error.get("message", "Unknown error")
-                print(f"    • {inv.id} — {code}")
-                print(f"      Customer: {inv.customer_email or inv.customer}")
-                print(f"      Amount: {inv.amount_due / 100:.2f} {inv.currency.upper()}")
-                print(f"      Error: {error_msg}")
+                out.append(f"    • {inv.id} — {code}")
+                out.append(f"      Customer: {inv.customer_email or inv.customer}")
+                out.append(f"      Amount: {inv.amount_due / 100:.2f} {inv.currency.upper()}")
+                out.append(f"      Error: {error_msg}")
                 
                 # Retry recommendation
                 if category == "TEMPORARY":
-                    print(f"      ✓ RETRY: Safe to retry immediately")
+                    out.append(f"      ✓ RETRY: Safe to retry immediately")
                 elif category == "ACTION_REQUIRED":
-                    print(f"      ⚠️  ACTION: Customer must complete 3DS or similar")
+                    out.append(f"      ⚠️  ACTION: Customer must complete 3DS or similar")
                 elif category == "PERMANENT":
                     failure_guidance = PERMANENT_FAILURES.get(code, "Contact customer")
-                    print(f"      ✗ NO RETRY: {failure_guidance}")
+                    out.append(f"      ✗ NO RETRY: {failure_guidance}")
                 else:
-                    print(f"      ? UNKNOWN: Investigate and retry manually")
+                    out.append(f"      ? UNKNOWN: Investigate and retry manually")
     
     # Print recommendations
-    print("\n" + "=" * 70)
-    print("  RECOMMENDATIONS")
-    print("=" * 70)
-    
-    if breakdown["TEMPORARY"]:
-        print(f"\n  1. RETRY TEMPORARY FAILURES ({len(breakdown['TEMPORARY'])} invoices)")
-        print("     → These are safe to retry immediately.")
-        print("     → Use exponential backoff: 1 sec, 2 sec, 4 sec between retries.")
-        print("     → Max 3 retries per invoice.")
-    
-    if breakdown["PERMANENT"]:
-        print(f"\n  2. NOTIFY CUSTOMERS OF PERMANENT FAILURES ({len(breakdown['PERMANENT'])} invoices)")
-        print("     → Send email asking them to update their payment method.")
-        print("     → Link to billing dashboard or payment update form.")
-        print("     → Example: 'Your subscription payment failed because your card")
-        print("       was declined. Please update your card details to reactivate.")
-        print("       No charges will be applied until you update.'")
-    
-    if breakdown["ACTION_REQUIRED"]:
-        print(f"\n  3. TRIGGER 3D SECURE OR PAYMENT ACTION ({len(breakdown['ACTION_REQUIRED'])} invoices)")
-        print("     → Customer must authenticate payment via 3D Secure.")
-        print("     → Send email: 'Your payment needs verification. Please complete")
-        print("       the authentication on your billing page.'")
-    
-    print("\n" + "=" * 70)
-    print("  AUTOMATION STRATEGY")
-    print("=" * 70)
-    print("\n  Listen to webhook: invoice.payment_failed")
-    print("  → Immediately retry temporary failures (1 sec delay)")
-    print("  → After 1 hour, retry again if still temporary")
-    print("  → After 6 hours, notify customer of permanent failure")
-    print("  → Never retry permanent failures (wastes API calls)")
-    print("\n  Listen to webhook: invoice.payment_action_required")
-    print("  → Email customer with authentication link")
-    print("  → Retry after customer completes action")
-    print("=" * 70)
+    out.append("\n" + "=" * 70)
+    out.append("  RECOMMENDATIONS")
+    out.append("=" * 70)
+    
+    if counts["TEMPORARY"]:
+        out.append(f"\n  1. RETRY TEMPORARY FAILURES ({counts['TEMPORARY']} invoices)")
+        out.append("     → These are safe to retry immediately.")
+        out.append("     → Use exponential backoff: 1 sec, 2 sec, 4 sec between retries.")
+        out.append("     → Max 3 retries per invoice.")
+    
+    if counts["PERMANENT"]:
+        out.append(f"\n  2. NOTIFY CUSTOMERS OF PERMANENT FAILURES ({counts['PERMANENT']} invoices)")
+        out.append("     → Send email asking them to update their payment method.")
+        out.append("     → Link to billing dashboard or payment update form.")
+        out.append("     → Example: 'Your subscription payment failed because your card")
+        out.append("       was declined. Please update your card details to reactivate.")
+        out.append("       No charges will be applied until you update.'")
+    
+    if counts["ACTION_REQUIRED"]:
+        out.append(f"\n  3. TRIGGER 3D SECURE OR PAYMENT ACTION ({counts['ACTION_REQUIRED']} invoices)")
+        out.append("     → Customer must authenticate payment via 3D Secure.")
+        out.append("     → Send email: 'Your payment needs verification. Please complete")
+        out.append("       the authentication on your billing page.'")
+    
+    out.append("\n" + "=" * 70)
+    out.append("  AUTOMATION STRATEGY")
+    out.append("=" * 70)
+    out.append("\n  Listen to webhook: invoice.payment_failed")
+    out.append("  → Skip event ids already in processed_stripe_events (Stripe retries)")
+    out.append("  → Immediately retry temporary failures (1 sec delay)")
+    out.append("  → After 1 hour, retry again if still temporary")
+    out.append("  → After 6 hours, notify customer of permanent failure")
+    out.append("  → Never retry permanent failures (wastes API calls)")
+    out.append("\n  Listen to webhook: invoice.payment_action_required")
+    out.append("  → Email customer with authentication link")
+    out.append("  → Retry after customer completes action")
+    out.append("\n  Record each event id only after its retry/notification succeeds,")
+    out.append("  in the same transaction, so a failed attempt is redelivered cleanly.")
+    out.append("=" * 70)
+    
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 if __name__ == "__main__":
@@ -3,26 +3,62 @@ Ticket 07 — Payout Delay Root-Cause Investigation
 Diagnose why payouts have stopped and identify the root cause.
 """
 
+import functools
 import os
+import sys
+import requests
 import stripe
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from operator import itemgetter
 import time
 
-load_dotenv()
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+
+@functools.cache
+def configure_stripe():
+    """
+    Load .env and set up the Stripe client on first API use rather than at
+    import, so the helpers here can be imported without touching disk.
+    """
+    load_dotenv()
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+
+    # The concurrent account, balance and payout lookups share one pool.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+    stripe.default_http_client = stripe.RequestsClient(session=session, verify_ssl_certs=True)
+
+_amount = itemgetter("amount")
+
+STATUS_ICON = {"paid": "✓", "failed": "✗"}
+DEFAULT_STATUS_ICON = "⏳"
+ENABLED_LABEL = {True: "✓ ENABLED", False: "✗ DISABLED"}
 
 
 def fetch_recent_payouts(limit=10):
-    """Fetch recent payout attempts to see status and timing."""
-    payouts_list = stripe.Payout.list(limit=limit)
-    return list(payouts_list.auto_paging_iter())
+    """
+    Fetch recent payout attempts to see status and timing.
+    A single page of `limit` is enough — auto-paging would walk the
+    account's entire payout history.
+    """
+    configure_stripe()
+    return stripe.Payout.list(limit=limit).data
+
 
+def fetch_account():
+    """
+    Retrieve the account once — restrictions and bank details are both
+    read from the same object, so there's no second identical round-trip.
+    """
+    configure_stripe()
+    return stripe.Account.retrieve()
 
-def check_account_restrictions():
+
+def check_account_restrictions(account):
     """Check if account has holds, restrictions, or verification issues."""
-    account = stripe.Account.retrieve()
-    
     restrictions = {
         "charges_enabled": account.charges_enabled,
         "payouts_enabled": account.payouts_enabled,
@@ -30,19 +66,19 @@ def check_account_restrictions():
         "disabled_reason": account.get("disabled_reason"),
     }
     
-    return restrictions, account
+    return restrictions
 
 
 def fetch_balance():
     """Get current balance breakdown."""
+    configure_stripe()
     balance = stripe.Balance.retrieve()
     return balance
 
 
-def fetch_bank_account_verification():
+def fetch_bank_account_verification(account):
     """Check the external account (bank) verification status."""
     try:
-        account = stripe.Account.retrieve()
         external_accounts = account.external_accounts.data if account.external_accounts else []
         
         if external_accounts:
@@ -53,106 +89,98 @@ def fetch_bank_account_verification():
         return None
 
 
-def fetch_balance_transactions(limit=50):
-    """Fetch recent balance transactions to understand money flow."""
-    transactions = stripe.BalanceTransaction.list(limit=limit)
-    return list(transactions.auto_paging_iter())
-
-
 def analyze_payout_history(payouts_list):
     """Analyze payout patterns to find when they stopped."""
     if not payouts_list:
         return None, None
     
-    # Find last successful payout
-    last_success = None
-    first_failure = None
-    
-    for payout in payouts_list:
-        if payout.status == "paid":
-            if not last_success:
-                last_success = payout
-        elif payout.status in ["failed", "canceled"]:
-            if not first_failure:
-                first_failure = payout
+    # Payouts are listed newest first — each search stops at its first match
+    last_success = next((p for p in payouts_list if p.status == "paid"), None)
+    first_failure = next((p for p in payouts_list if p.status in ("failed", "canceled")), None)
     
     return last_success, first_failure
 
 
+MockPayout = namedtuple("MockPayout", "id amount status failure_code created")
+
+# (id, amount, status, failure_code, seconds before now) — timestamps are
+# relative, so only the final `created` values are computed per call.
+DEMO_PAYOUTS = (
+    # Last successful payout (3 days ago)
+    ("po_demo_001", 18500, "paid", None, (3600 * 72) + 7200),
+    
+    # Failed attempts since then
+    ("po_demo_002", 19200, "failed", "account_closed", 3600 * 48),
+    ("po_demo_003", 19200, "failed", "account_closed", 3600 * 24),
+    ("po_demo_004", 19200, "failed", "account_closed", 3600 * 12),
+    ("po_demo_005", 19200, "failed", "account_closed", 3600),
+)
+
+
 def get_demo_payouts():
     """Return mock payouts matching the SwiftShop scenario."""
-    class MockPayout:
-        def __init__(self, payout_id, amount, status, failure_code, created_ts):
-            self.id = payout_id
-            self.amount = amount
-            self.status = status
-            self.failure_code = failure_code
-            self.created = created_ts
-    
     now = int(time.time())
-    
     return [
-        # Last successful payout (3 days ago)
-        MockPayout("po_demo_001", 18500, "paid", None, now - (3600 * 72) - 7200),
-        
-        # Failed attempts since then
-        MockPayout("po_demo_002", 19200, "failed", "account_closed", now - (3600 * 48)),
-        MockPayout("po_demo_003", 19200, "failed", "account_closed", now - (3600 * 24)),
-        MockPayout("po_demo_004", 19200, "failed", "account_closed", now - (3600 * 12)),
-        MockPayout("po_demo_005", 19200, "failed", "account_closed", now - 3600),
+        MockPayout(payout_id, amount, status, failure_code, now - age)
+        for payout_id, amount, status, failure_code, age in DEMO_PAYOUTS
     ]
 
 
-def print_diagnostic_report(payouts_list, restrictions, balance, bank_account, transactions):
-    """Print comprehensive payout delay diagnostic."""
-    
-    print("=" * 70)
-    print("  PAYOUT DELAY ROOT-CAUSE INVESTIGATION")
-    print("  SwiftShop GmbH (Munich)")
-    print("=" * 70)
+def print_diagnostic_report(payouts_list, restrictions, balance, bank_account):
+    """
+    Print comprehensive payout delay diagnostic.
+    The report is collected line by line and written to stdout once.
+    """
+    out = []
+    
+    out.append("=" * 70)
+    out.append("  PAYOUT DELAY ROOT-CAUSE INVESTIGATION")
+    out.append("  SwiftShop GmbH (Munich)")
+    out.append("=" * 70)
     
     # Section 1: Account Status
-    print("\n" + "=" * 70)
-    print("  ACCOUNT STATUS")
-    print("=" * 70)
+    out.append("\n" + "=" * 70)
+    out.append("  ACCOUNT STATUS")
+    out.append("=" * 70)
     
-    charges = "✓ ENABLED" if restrictions["charges_enabled"] else "✗ DISABLED"
-    payouts_status = "✓ ENABLED" if restrictions["payouts_enabled"] else "✗ DISABLED"
+    charges = ENABLED_LABEL[bool(restrictions["charges_enabled"])]
+    payouts_status = ENABLED_LABEL[bool(restrictions["payouts_enabled"])]
     
-    print(f"\n  Charges:     {charges}")
-    print(f"  Payouts:     {payouts_status}")
+    out.append(f"\n  Charges:     {charges}")
+    out.append(f"  Payouts:     {payouts_status}")
     
     if restrictions["disabled_reason"]:
-        print(f"  Disabled:    {restrictions['disabled_reason']}")
+        out.append(f"  Disabled:    {restrictions['disabled_reason']}")
     
     # Check for requirements
     reqs = restrictions.get("requirements", {})
     if reqs.get("currently_due"):
-        print(f"\n  ⚠️  REQUIREMENTS BLOCKING PAYOUTS:")
+        out.append(f"\n  ⚠️  REQUIREMENTS BLOCKING PAYOUTS:")
         for req in reqs["currently_due"][:5]:
-            print(f"    - {req}")
+            out.append(f"    - {req}")
         if len(reqs["currently_due"]) > 5:
-            print(f"    ... and {len(reqs['currently_due']) - 5} more")
+            out.append(f"    ... and {len(reqs['currently_due']) - 5} more")
     
     # Section 2: Recent Payouts
-    print("\n" + "=" * 70)
-    print("  RECENT PAYOUT ATTEMPTS (Last 10)")
-    print("=" * 70)
+    out.append("\n" + "=" * 70)
+    out.append("  RECENT PAYOUT ATTEMPTS (Last 10)")
+    out.append("=" * 70)
     
     if not payouts_list:
-        print("\n  No payouts found.")
+        out.append("\n  No payouts found.")
     else:
         for i, payout in enumerate(payouts_list[:10], 1):
-            status_icon = "✓" if payout.status == "paid" else "✗" if payout.status == "failed" else "⏳"
-            created = datetime.fromtimestamp(payout.created).strftime("%Y-%m-%d %H:%M:%S")
+            status_icon = STATUS_ICON.get(payout.status, DEFAULT_STATUS_ICON)
+            # Same text as strftime("%Y-%m-%d %H:%M:%S"), without parsing a format string
+            created = datetime.fromtimestamp(payout.created).isoformat(sep=" ", timespec="seconds")
             
-            print(f"\n  {i}. {payout.id}")
-            print(f"     Status:     {payout.status.upper()} {status_icon}")
-            print(f"     Amount:     {payout.amount / 100:.2f} EUR")
-            print(f"     Created:    {created}")
+            out.append(f"\n  {i}. {payout.id}")
+            out.append(f"     Status:     {payout.status.upper()} {status_icon}")
+            out.append(f"     Amount:     {payout.amount / 100:.2f} EUR")
+            out.append(f"     Created:    {created}")
             
             if payout.failure_code:
-                print(f"     Failure:    {payout.failure_code}")
+                out.append(f"     Failure:    {payout.failure_code}")
     
     # Find patterns
     last_success, first_failure = analyze_payout_history(payouts_list)
@@ -162,51 +190,51 @@ def print_diagnostic_report(payouts_list, restrictions, balance, bank_account, t
         first_ts = datetime.fromtimestamp(first_failure.created)
         gap = first_ts - last_ts
         
-        print(f"\n  Last successful payout: {last_success.id} on {last_ts.strftime('%Y-%m-%d at %H:%M')}")
-        print(f"  First failed payout:    {first_failure.id} on {first_ts.strftime('%Y-%m-%d at %H:%M')}")
-        print(f"  Gap between:            {gap.days} day(s), {gap.seconds // 3600} hours")
+        out.append(f"\n  Last successful payout: {last_success.id} on {last_ts.strftime('%Y-%m-%d at %H:%M')}")
+        out.append(f"  First failed payout:    {first_failure.id} on {first_ts.strftime('%Y-%m-%d at %H:%M')}")
+        out.append(f"  Gap between:            {gap.days} day(s), {gap.seconds // 3600} hours")
     
     # Section 3: Balance
-    print("\n" + "=" * 70)
-    print("  CURRENT BALANCE")
-    print("=" * 70)
+    out.append("\n" + "=" * 70)
+    out.append("  CURRENT BALANCE")
+    out.append("=" * 70)
     
     available = balance.get("available", [])
     pending = balance.get("pending", [])
     
-    total_available = sum(b["amount"] for b in available) / 100
-    total_pending = sum(b["amount"] for b in pending) / 100
+    total_available = sum(map(_amount, available)) / 100
+    total_pending = sum(map(_amount, pending)) / 100
     
-    print(f"\n  Available:  €{total_available:.2f}")
-    print(f"  Pending:    €{total_pending:.2f}")
-    print(f"  Total:      €{(total_available + total_pending):.2f}")
+    out.append(f"\n  Available:  €{total_available:.2f}")
+    out.append(f"  Pending:    €{total_pending:.2f}")
+    out.append(f"  Total:      €{(total_available + total_pending):.2f}")
     
     if total_pending > 5000:
-        print(f"\n  ⚠️  Large pending balance ({total_pending:.2f} EUR)")
-        print(f"      This suggests payouts aren't being sent out.")
+        out.append(f"\n  ⚠️  Large pending balance ({total_pending:.2f} EUR)")
+        out.append(f"      This suggests payouts aren't being sent out.")
     
     # Section 4: Bank Account
-    print("\n" + "=" * 70)
-    print("  BANK ACCOUNT VERIFICATION")
-    print("=" * 70)
+    out.append("\n" + "=" * 70)
+    out.append("  BANK ACCOUNT VERIFICATION")
+    out.append("=" * 70)
     
     if bank_account:
-        print(f"\n  Account:     {bank_account.get('display_name', 'N/A')}")
-        print(f"  Last 4:      {bank_account.get('last4', 'N/A')}")
-        print(f"  Bank Name:   {bank_account.get('bank_name', 'N/A')}")
-        print(f"  Status:      {bank_account.get('status', 'N/A')}")
+        out.append(f"\n  Account:     {bank_account.get('display_name', 'N/A')}")
+        out.append(f"  Last 4:      {bank_account.get('last4', 'N/A')}")
+        out.append(f"  Bank Name:   {bank_account.get('bank_name', 'N/A')}")
+        out.append(f"  Status:      {bank_account.get('status', 'N/A')}")
         
         if bank_account.get("status") != "verified":
-            print(f"\n  ⚠️  Bank account is NOT verified!")
-            print(f"      This is likely blocking payouts.")
+            out.append(f"\n  ⚠️  Bank account is NOT verified!")
+            out.append(f"      This is likely blocking payouts.")
     else:
-        print("\n  ✗ No external bank account configured!")
-        print("     Payouts cannot be sent without a bank account.")
+        out.append("\n  ✗ No external bank account configured!")
+        out.append("     Payouts cannot be sent without a bank account.")
     
     # Section 5: Recommendations
-    print("\n" + "=" * 70)
-    print("  ROOT-CAUSE ANALYSIS & RECOMMENDATIONS")
-    print("=" * 70)
+    out.append("\n" + "=" * 70)
+    out.append("  ROOT-CAUSE ANALYSIS & RECOMMENDATIONS")
+    out.append("=" * 70)
     
     issues = []
     
@@ -232,30 +260,42 @@ def print_diagnostic_report(payouts_list, restrictions, balance, bank_account, t
                       "Systematic issue — not a one-time glitch."))
     
     if not issues:
-        print("\n  ✓ No obvious blocking issues found.")
-        print("    This may be a temporary Stripe processing delay.")
-        print("    Recommended action: Monitor for next 6 hours, then contact Stripe if continues.")
+        out.append("\n  ✓ No obvious blocking issues found.")
+        out.append("    This may be a temporary Stripe processing delay.")
+        out.append("    Recommended action: Monitor for next 6 hours, then contact Stripe if continues.")
     else:
         for severity, issue, action in issues:
-            print(f"\n  [{severity}] {issue}")
-            print(f"  → Action: {action}")
+            out.append(f"\n  [{severity}] {issue}")
+            out.append(f"  → Action: {action}")
+    
+    out.append("\n" + "=" * 70)
     
-    print("\n" + "=" * 70)
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 if __name__ == "__main__":
     print("Investigating payout delays...\n")
     
-    payouts_list = fetch_recent_payouts(limit=10)
+    # Configure once up front so the worker threads don't race to build it.
+    configure_stripe()
+
+    # The lookups are independent network round-trips — issue them together
+    # so the diagnostic waits for the slowest call, not the sum of them all.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        payouts_future = executor.submit(fetch_recent_payouts, limit=10)
+        account_future = executor.submit(fetch_account)
+        balance_future = executor.submit(fetch_balance)
+    
+    payouts_list = payouts_future.result()
     
     # If no real payouts, use demo data
     if not payouts_list:
         print("(No real payouts in test account — using demo data)\n")
         payouts_list = get_demo_payouts()
     
-    restrictions, account = check_account_restrictions()
-    balance = fetch_balance()
-    bank_account = fetch_bank_account_verification()
-    transactions = fetch_balance_transactions(limit=50)
+    account = account_future.result()
+    restrictions = check_account_restrictions(account)
+    bank_account = fetch_bank_account_verification(account)
+    balance = balance_future.result()
     
-    print_diagnostic_report(payouts_list, restrictions, balance, bank_account, transactions)
+    print_diagnostic_report(payouts_list, restrictions, balance, bank_account)
@@ -4,13 +4,28 @@ Demonstrate how PaymentIntents handle Strong Customer Authentication (3DS).
 """
 
 import os
+import sys
+import requests
 import stripe
 from datetime import datetime
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# Create and confirm calls reuse one keep-alive connection.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(session=_session, verify_ssl_certs=True)
+
+SEP = "=" * 70
+
+
+def _section(title):
+    """Banner that opens each section of the guide."""
+    return f"\n{SEP}\n  {title}\n{SEP}"
+
 
 def create_payment_intent_with_3ds(amount, currency="eur", description="3DS Test"):
     """Create a PaymentIntent that will trigger 3D Secure."""
@@ -31,6 +46,10 @@ def confirm_payment_with_test_card(intent_id, test_card="4000002500003010"):
     - 4000002500003010 (Requires 3DS) ← Most common for testing
     - 4000000000003220 (Requires 3DS with redirect)
     - 4242424242424242 (No 3DS required)
+    
+    Always returns a dict keyed on "ok": {"ok": True, "intent": ...} on
+    success, or the decline's code, decline_code, param and message with
+    "ok": False. The CardError itself (and its traceback) isn't kept.
     """
     try:
         intent = stripe.PaymentIntent.confirm(
@@ -46,9 +65,15 @@ def confirm_payment_with_test_card(intent_id, test_card="4000002500003010"):
             },
             return_url="https://example.com/checkout/complete",
         )
-        return intent
     except stripe.error.CardError as e:
-        return None, e
+        return {
+            "ok": False,
+            "code": e.code,
+            "decline_code": e.error and e.error.decline_code,
+            "param": e.param,
+            "message": e.user_message,
+        }
+    return {"ok": True, "intent": intent}
 
 
 def get_demo_3ds_flow():
@@ -103,18 +128,17 @@ def get_demo_3ds_flow():
 
 def print_psd2_compliance_guide():
     """Print a comprehensive PSD2/3DS implementation guide."""
+    out = []
     
-    print("=" * 70)
-    print("  PSD2 / SCA / 3D SECURE IMPLEMENTATION GUIDE")
-    print("  TechnoShop GmbH (Berlin)")
-    print("=" * 70)
+    out.append(SEP)
+    out.append("  PSD2 / SCA / 3D SECURE IMPLEMENTATION GUIDE")
+    out.append("  TechnoShop GmbH (Berlin)")
+    out.append(SEP)
     
     # Section 1: What is PSD2?
-    print("\n" + "=" * 70)
-    print("  WHAT IS PSD2 AND STRONG CUSTOMER AUTHENTICATION (SCA)?")
-    print("=" * 70)
+    out.append(_section("WHAT IS PSD2 AND STRONG CUSTOMER AUTHENTICATION (SCA)?"))
     
-    print("""
+    out.append("""
   PSD2 (Payment Services Directive 2) is an EU regulation requiring
   Strong Customer Authentication (SCA) for online card payments.
   
@@ -132,11 +156,9 @@ def print_psd2_compliance_guide():
     """)
     
     # Section 2: How Stripe Handles 3DS
-    print("\n" + "=" * 70)
-    print("  HOW STRIPE AUTOMATICALLY HANDLES 3D SECURE")
-    print("=" * 70)
+    out.append(_section("HOW STRIPE AUTOMATICALLY HANDLES 3D SECURE"))
     
-    print("""
+    out.append("""
   Your current flow:
   1. Customer enters card details
   2. stripe.confirmCardPayment(clientSecret)
@@ -154,34 +176,30 @@ def print_psd2_compliance_guide():
     """)
     
     # Section 3: Test Flow
-    print("\n" + "=" * 70)
-    print("  TEST 3DS FLOW EXAMPLE")
-    print("=" * 70)
+    out.append(_section("TEST 3DS FLOW EXAMPLE"))
     
     demo = get_demo_3ds_flow()
     
-    print("\n  [SUCCESSFUL 3DS FLOW]")
-    print(f"  Intent ID: {demo['successful_3ds']['intent_id']}")
-    print(f"  Amount: €{demo['successful_3ds']['amount']/100:.2f}")
-    print(f"  Status: {demo['successful_3ds']['status']}")
-    print(f"\n  Steps:")
+    out.append("\n  [SUCCESSFUL 3DS FLOW]")
+    out.append(f"  Intent ID: {demo['successful_3ds']['intent_id']}")
+    out.append(f"  Amount: €{demo['successful_3ds']['amount']/100:.2f}")
+    out.append(f"  Status: {demo['successful_3ds']['status']}")
+    out.append(f"\n  Steps:")
     for step in demo['successful_3ds']['flow']:
-        print(f"    {step}")
+        out.append(f"    {step}")
     
-    print("\n  [FAILED 3DS FLOW]")
-    print(f"  Intent ID: {demo['failed_3ds']['intent_id']}")
-    print(f"  Amount: €{demo['failed_3ds']['amount']/100:.2f}")
-    print(f"  Status: {demo['failed_3ds']['status']}")
-    print(f"\n  Steps:")
+    out.append("\n  [FAILED 3DS FLOW]")
+    out.append(f"  Intent ID: {demo['failed_3ds']['intent_id']}")
+    out.append(f"  Amount: €{demo['failed_3ds']['amount']/100:.2f}")
+    out.append(f"  Status: {demo['failed_3ds']['status']}")
+    out.append(f"\n  Steps:")
     for step in demo['failed_3ds']['flow']:
-        print(f"    {step}")
+        out.append(f"    {step}")
     
     # Section 4: Frontend Code Example
-    print("\n" + "=" * 70)
-    print("  FRONTEND CODE PATTERN (JavaScript)")
-    print("=" * 70)
+    out.append(_section("FRONTEND CODE PATTERN (JavaScript)"))
     
-    print("""
+    out.append("""
   const stripe = Stripe('pk_test_...');
   const elements = stripe.elements();
   const cardElement = elements.create('card');
@@ -214,35 +232,49 @@ def print_psd2_compliance_guide():
     """)
     
     # Section 5: Backend Webhook Handling
-    print("\n" + "=" * 70)
-    print("  BACKEND WEBHOOK HANDLING (Python)")
-    print("=" * 70)
+    out.append(_section("BACKEND WEBHOOK HANDLING (Python)"))
     
-    print("""
+    out.append("""
   # Listen for these webhooks:
   
   @app.route('/webhook', methods=['POST'])
   def webhook():
     event = stripe.Event.construct_event(...)
+    intent = event['data']['object']
     
     if event['type'] == 'payment_intent.payment_action_required':
-      intent = event['data']['object']
       # 3DS authentication in progress
       print(f"3DS challenge pending for {intent['id']}")
     
     elif event['type'] == 'payment_intent.succeeded':
-      intent = event['data']['object']
-      # Payment is complete (3DS was successful)
-      print(f"Payment successful: {intent['id']}")
-      # Fulfill the order
+      # Payment is complete (3DS was successful) — hand fulfillment to a
+      # worker so Stripe gets its 200 without waiting on the database
+      enqueue("stripe.fulfill", {"intent_id": intent['id'], "event_id": event['id']})
     
     return jsonify({'status': 'ok'}), 200
+  
+  # Worker (Celery / RQ / SQS consumer):
+  
+  def fulfill(job):
+    # One transaction: the event id commits only if fulfillment succeeds
+    with db.transaction() as cur:
+      # Serialise concurrent jobs for the same PaymentIntent
+      cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (job['intent_id'],))
+      
+      # Stripe delivers at least once — skip events already handled
+      cur.execute(
+        "INSERT INTO processed_stripe_events (event_id) VALUES (%s) "
+        "ON CONFLICT DO NOTHING",
+        (job['event_id'],),
+      )
+      if cur.rowcount == 0:
+        return
+      
+      # Fulfill the order
     """)
     
     # Section 6: Compliance Checklist
-    print("\n" + "=" * 70)
-    print("  PSD2 COMPLIANCE CHECKLIST")
-    print("=" * 70)
+    out.append(_section("PSD2 COMPLIANCE CHECKLIST"))
     
     checklist = [
         ("Use PaymentIntents (not Charges)", "✓ Required"),
@@ -256,14 +288,12 @@ def print_psd2_compliance_guide():
     ]
     
     for item, status in checklist:
-        print(f"  ☐ {item:.<40} {status}")
+        out.append(f"  ☐ {item:.<40} {status}")
     
     # Section 7: Timeline & Action
-    print("\n" + "=" * 70)
-    print("  YOUR ACTION PLAN")
-    print("=" * 70)
+    out.append(_section("YOUR ACTION PLAN"))
     
-    print("""
+    out.append("""
   This week:
     □ Review your current Stripe integration
     □ Verify you're using PaymentIntents (not Charges)
@@ -283,11 +313,9 @@ def print_psd2_compliance_guide():
     ✓ Payment success rate maintained
     """)
     
-    print("\n" + "=" * 70)
-    print("  KEY TAKEAWAY")
-    print("=" * 70)
+    out.append(_section("KEY TAKEAWAY"))
     
-    print("""
+    out.append("""
   Stripe handles 3D Secure AUTOMATICALLY with PaymentIntents.
   You don't need to build custom 3DS logic.
   
@@ -299,7 +327,9 @@ def print_psd2_compliance_guide():
   That's it. You're PSD2 compliant.
     """)
     
-    print("=" * 70)
+    out.append(SEP)
+    
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 if __name__ == "__main__":
@@ -12,13 +12,32 @@ Demonstrates:
 - Regional considerations (PSD2, post-Brexit, etc.)
 """
 
+import hashlib
+import requests
 import stripe
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 
 # Configure Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# The concurrent test-scenario payments share one keep-alive connection pool.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(session=_session, verify_ssl_certs=True)
+
+SEP = "=" * 80
+
+
+def _section(title):
+    """Banner that opens each part of the walkthrough."""
+    return f"\n{SEP}\n{title}\n{SEP}"
+
+
 # GlobeShop's merchant configuration
 MERCHANT_CONFIG = {
     "business_name": "GlobeShop Ltd",
@@ -39,10 +58,18 @@ SUPPORTED_CURRENCIES = {
 # Approximate Stripe exchange rates (for demonstration)
 # Real implementation would use Stripe's live rates
 STRIPE_EXCHANGE_RATES = {
-    "gbp_to_usd": 1.27,
-    "gbp_to_eur": 1.17,
-    "gbp_to_jpy": 189.50,
-    "gbp_to_aud": 2.43,
+    ("gbp", "usd"): 1.27,
+    ("gbp", "eur"): 1.17,
+    ("gbp", "jpy"): 189.50,
+    ("gbp", "aud"): 2.43,
+}
+
+# Every (from, to) pair we can convert, with identity and inverse rates
+# precomputed so a conversion is a single tuple lookup
+RATES = {
+    **{(curr, curr): 1.0 for curr in SUPPORTED_CURRENCIES},
+    **STRIPE_EXCHANGE_RATES,
+    **{(to_curr, from_curr): 1 / rate for (from_curr, to_curr), rate in STRIPE_EXCHANGE_RATES.items()},
 }
 
 # Stripe's pricing for currency pairs (varies by pair)
@@ -55,6 +82,17 @@ STRIPE_FEE_BY_PAIR = {
     ("gbp", "aud"): 2.3,  # GBP->AUD, high fee
 }
 
+# Display rows for the reports, upper-cased once here instead of per line
+CURRENCY_ROWS = tuple(
+    (curr.upper(), info["country"], info["region"]) for curr, info in SUPPORTED_CURRENCIES.items()
+)
+RATE_ROWS = tuple(
+    (from_curr.upper(), to_curr.upper(), rate) for (from_curr, to_curr), rate in STRIPE_EXCHANGE_RATES.items()
+)
+FEE_ROWS = tuple(
+    (from_curr, from_curr.upper(), to_curr.upper(), fee) for (from_curr, to_curr), fee in STRIPE_FEE_BY_PAIR.items()
+)
+
 
 # ============================================================================
 # PART 1: CURRENCY DETECTION & SELECTION
@@ -92,15 +130,11 @@ def get_local_amount(base_amount_gbp: float, target_currency: str) -> float:
     
     Example: Customer in Japan wants to buy £20 item
     -> Convert to ¥3,790 (¥ = GBP * 189.50)
-    """
-    
-    if target_currency == "gbp":
-        return base_amount_gbp
-    
-    rate_key = f"gbp_to_{target_currency}"
-    rate = STRIPE_EXCHANGE_RATES.get(rate_key, 1.0)
     
-    return round(base_amount_gbp * rate, 2)
+    Raises KeyError for an unsupported currency rather than silently
+    charging the unconverted amount.
+    """
+    return round(base_amount_gbp * RATES[("gbp", target_currency)], 2)
 
 
 # ============================================================================
@@ -111,7 +145,8 @@ def create_multi_currency_payment(
     order_id: str,
     amount_gbp: float,
     customer_country: str = "US",
-    charge_in_local_currency: bool = True
+    charge_in_local_currency: bool = True,
+    record_intent=None
 ) -> dict:
     """
     Create PaymentIntent in customer's local currency.
@@ -129,6 +164,11 @@ def create_multi_currency_payment(
     
     GlobeShop's strategy: Charge in customer's local currency
     to maximize conversion and minimize payment friction.
+    
+    The intent is created unconfirmed, handed to `record_intent(order_id,
+    intent_id)` so the order row can store it, and only then confirmed —
+    otherwise payment_intent.succeeded can reach the webhook before the
+    order knows its intent id.
     """
     
     # Detect customer's currency
@@ -148,13 +188,18 @@ def create_multi_currency_payment(
     # Convert to cents for Stripe API
     amount_cents = int(payment_amount * 100)
     
+    # Deterministic per order, so a retried create after a network error
+    # returns the original intent instead of charging the customer twice.
+    # Scoped to this create call — confirm/refund need keys of their own.
+    idempotency_key = hashlib.sha256(
+        f"pi_create:{order_id}:{customer_country}:{currency}:{amount_gbp}".encode()
+    ).hexdigest()
+    
     # Create PaymentIntent using test payment method
     intent = stripe.PaymentIntent.create(
         amount=amount_cents,
         currency=currency,
         payment_method="pm_card_visa",
-        confirm=True,
-        return_url="https://mystore.com/checkout/success",
         metadata={
             "order_id": order_id,
             "customer_country": customer_country,
@@ -162,7 +207,18 @@ def create_multi_currency_payment(
             "base_amount_gbp": str(amount_gbp),
             "merchant_name": MERCHANT_CONFIG["business_name"],
         },
-        description=f"Order {order_id} - GlobeShop Ltd"
+        description=f"Order {order_id} - GlobeShop Ltd",
+        idempotency_key=idempotency_key,
+    )
+    
+    # Persist the intent id before any success event can be sent
+    if record_intent is not None:
+        record_intent(order_id, intent.id)
+    
+    intent = stripe.PaymentIntent.confirm(
+        intent.id,
+        return_url="https://mystore.com/checkout/success",
+        idempotency_key=f"pi_confirm:{intent.id}",
     )
     
     return {
@@ -173,6 +229,7 @@ def create_multi_currency_payment(
         "payment_amount": payment_amount,
         "amount_cents": amount_cents,
         "intent_id": intent.id,
+        "idempotency_key": idempotency_key,
         "status": intent.status,
         "success": intent.status == "succeeded"
     }
@@ -189,36 +246,52 @@ def explain_exchange_rates_and_fees(base_currency: str = "gbp"):
     
     KEY CONCEPT: Interchange fees vary by currency pair.
     """
+    out = []
     
-    print("\n" + "="*80)
-    print("EXCHANGE RATES & FEES EXPLANATION")
-    print("="*80)
+    out.append(_section("EXCHANGE RATES & FEES EXPLANATION"))
     
-    print(f"\nMerchant's base currency: {base_currency.upper()}")
-    print(f"Settlement currency: {base_currency.upper()} (to {MERCHANT_CONFIG['location']} bank)")
+    out.append(f"\nMerchant's base currency: {base_currency.upper()}")
+    out.append(f"Settlement currency: {base_currency.upper()} (to {MERCHANT_CONFIG['location']} bank)")
     
-    print("\nStripe's exchange rates (live rates vary):")
-    for rate_key, rate in STRIPE_EXCHANGE_RATES.items():
-        from_curr, to_curr = rate_key.split("_to_")
-        print(f"  {from_curr.upper()} → {to_curr.upper()}: 1 {from_curr.upper()} = {rate} {to_curr.upper()}")
+    out.append("\nStripe's exchange rates (live rates vary):")
+    for from_label, to_label, rate in RATE_ROWS:
+        out.append(f"  {from_label} → {to_label}: 1 {from_label} = {rate} {to_label}")
     
-    print("\nStripe's pricing by currency pair (GBP merchant):")
-    for (from_curr, to_curr), fee in STRIPE_FEE_BY_PAIR.items():
+    out.append("\nStripe's pricing by currency pair (GBP merchant):")
+    for from_curr, from_label, to_label, fee in FEE_ROWS:
         if from_curr == base_currency:
-            print(f"  {from_curr.upper()} → {to_curr.upper()}: {fee}% (includes card network & processing)")
+            out.append(f"  {from_label} → {to_label}: {fee}% (includes card network & processing)")
     
-    print("\nKey insights:")
-    print("  • Stripe's rates are competitive vs. traditional payment processors")
-    print("  • Same currency charges (GBP→GBP) have slightly lower fees")
-    print("  • Some pairs (EUR/USD) have lower fees due to high volume")
-    print("  • Cross-border fees reflect actual FX risk + network costs")
-    print("  • Volatile pairs (GBP/JPY) have higher fees")
+    out.append("\nKey insights:")
+    out.append("  • Stripe's rates are competitive vs. traditional payment processors")
+    out.append("  • Same currency charges (GBP→GBP) have slightly lower fees")
+    out.append("  • Some pairs (EUR/USD) have lower fees due to high volume")
+    out.append("  • Cross-border fees reflect actual FX risk + network costs")
+    out.append("  • Volatile pairs (GBP/JPY) have higher fees")
+    
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 # ============================================================================
 # PART 4: MULTI-CURRENCY BALANCE & SETTLEMENT
 # ============================================================================
 
+# Balance only moves when charges settle, so a short-lived copy is fine for
+# reports that re-render often
+BALANCE_TTL_SECONDS = 30
+_balance_cache = {"fetched_at": None, "balance": None}
+
+
+def fetch_balance():
+    """Return the account balance, re-fetching at most once per TTL window."""
+    now = time.monotonic()
+    fetched_at = _balance_cache["fetched_at"]
+    if fetched_at is None or now - fetched_at >= BALANCE_TTL_SECONDS:
+        _balance_cache["balance"] = stripe.Balance.retrieve()
+        _balance_cache["fetched_at"] = now
+    return _balance_cache["balance"]
+
+
 def retrieve_multi_currency_balance():
     """
     Retrieve balance across all currencies.
@@ -227,44 +300,45 @@ def retrieve_multi_currency_balance():
     Settlement can happen in any supported currency, though fees apply
     if converting to a non-primary currency.
     """
+    out = []
     
-    print("\n" + "="*80)
-    print("MULTI-CURRENCY BALANCE BREAKDOWN")
-    print("="*80)
+    out.append(_section("MULTI-CURRENCY BALANCE BREAKDOWN"))
     
-    balance = stripe.Balance.retrieve()
+    balance = fetch_balance()
     
-    print(f"\nBalance retrieved at: {datetime.now().isoformat()}")
+    out.append(f"\nBalance retrieved at: {datetime.now().isoformat()}")
     
     # Available balance (ready to payout)
-    print("\nAVAILABLE BALANCE (can be paid out immediately):")
+    out.append("\nAVAILABLE BALANCE (can be paid out immediately):")
     if balance['available']:
         for curr_balance in balance['available']:
             amount = curr_balance['amount'] / 100
             currency = curr_balance['currency'].upper()
-            print(f"  {currency}: {amount:.2f} (available to settle)")
+            out.append(f"  {currency}: {amount:.2f} (available to settle)")
     else:
-        print("  (No balance available)")
+        out.append("  (No balance available)")
     
     # Pending balance (waiting for hold to lift)
-    print("\nPENDING BALANCE (2-7 day hold):")
+    out.append("\nPENDING BALANCE (2-7 day hold):")
     if balance['pending']:
         for curr_balance in balance['pending']:
             amount = curr_balance['amount'] / 100
             currency = curr_balance['currency'].upper()
-            print(f"  {currency}: {amount:.2f} (pending hold)")
+            out.append(f"  {currency}: {amount:.2f} (pending hold)")
     else:
-        print("  (No pending balance)")
+        out.append("  (No pending balance)")
     
     # Instant payout balance (if enabled)
-    print("\nINSTANT PAYOUT BALANCE (if instant payouts enabled):")
+    out.append("\nINSTANT PAYOUT BALANCE (if instant payouts enabled):")
     if balance.get('instant_available'):
         for curr_balance in balance['instant_available']:
             amount = curr_balance['amount'] / 100
             currency = curr_balance['currency'].upper()
-            print(f"  {currency}: {amount:.2f} (instant available)")
+            out.append(f"  {currency}: {amount:.2f} (instant available)")
     else:
-        print("  (Not enabled for this account)")
+        out.append("  (Not enabled for this account)")
+    
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 # ============================================================================
@@ -275,42 +349,43 @@ def explain_settlement_strategy():
     """
     Explain GlobeShop's multi-currency settlement strategy.
     """
+    out = []
+    
+    out.append(_section("SETTLEMENT & REPORTING STRATEGY"))
+    
+    out.append("\nGlobeShop's Approach:")
+    out.append("1. Charge customers in their local currency (best for conversions)")
+    out.append("2. Settle in GBP (default) weekly")
+    out.append("3. Hold 2-3 days for fraud review (standard)")
+    out.append("4. Monitor balances by currency in Dashboard")
+    
+    out.append("\nAlternative approaches (if they change strategy):")
+    out.append("\nOption A: Charge in GBP always")
+    out.append("  ✓ Simpler accounting")
+    out.append("  ✓ No FX risk on settlement")
+    out.append("  ✗ Higher decline rates")
+    out.append("  ✗ Worse customer experience")
+    
+    out.append("\nOption B: Charge in local, settle in local")
+    out.append("  ✓ No conversion fees on settlement")
+    out.append("  ✓ Better for tax reporting")
+    out.append("  ✗ Need separate bank accounts per currency")
+    out.append("  ✗ More complex reconciliation")
+    
+    out.append("\nOption C: Mixed approach by region")
+    out.append("  ✓ EU customers in EUR (PSD2 compliant)")
+    out.append("  ✓ US customers in USD (standard)")
+    out.append("  ✓ Other customers in GBP")
+    out.append("  ✗ More logic in checkout")
+    
+    out.append("\nRegional Considerations:")
+    out.append("  • EU (PSD2): Strong Customer Auth required for remote cards")
+    out.append("    → Stripe handles this with PaymentIntents")
+    out.append("  • UK (post-Brexit): Still uses £ for all customers")
+    out.append("  • APAC (Japan/AU): High demand for local currencies")
+    out.append("  • All regions: Vary FX rates daily")
     
-    print("\n" + "="*80)
-    print("SETTLEMENT & REPORTING STRATEGY")
-    print("="*80)
-    
-    print("\nGlobeShop's Approach:")
-    print("1. Charge customers in their local currency (best for conversions)")
-    print("2. Settle in GBP (default) weekly")
-    print("3. Hold 2-3 days for fraud review (standard)")
-    print("4. Monitor balances by currency in Dashboard")
-    
-    print("\nAlternative approaches (if they change strategy):")
-    print("\nOption A: Charge in GBP always")
-    print("  ✓ Simpler accounting")
-    print("  ✓ No FX risk on settlement")
-    print("  ✗ Higher decline rates")
-    print("  ✗ Worse customer experience")
-    
-    print("\nOption B: Charge in local, settle in local")
-    print("  ✓ No conversion fees on settlement")
-    print("  ✓ Better for tax reporting")
-    print("  ✗ Need separate bank accounts per currency")
-    print("  ✗ More complex reconciliation")
-    
-    print("\nOption C: Mixed approach by region")
-    print("  ✓ EU customers in EUR (PSD2 compliant)")
-    print("  ✓ US customers in USD (standard)")
-    print("  ✓ Other customers in GBP")
-    print("  ✗ More logic in checkout")
-    
-    print("\nRegional Considerations:")
-    print("  • EU (PSD2): Strong Customer Auth required for remote cards")
-    print("    → Stripe handles this with PaymentIntents")
-    print("  • UK (post-Brexit): Still uses £ for all customers")
-    print("  • APAC (Japan/AU): High demand for local currencies")
-    print("  • All regions: Vary FX rates daily")
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 # ============================================================================
@@ -322,9 +397,7 @@ def show_webhook_example():
     Show webhook structure for multi-currency payments.
     """
     
-    print("\n" + "="*80)
-    print("WEBHOOK HANDLING FOR MULTI-CURRENCY CHARGES")
-    print("="*80)
+    print(_section("WEBHOOK HANDLING FOR MULTI-CURRENCY CHARGES"))
     
     print("""
     @app.route('/webhooks/stripe', methods=['POST'])
@@ -332,7 +405,33 @@ def show_webhook_example():
         event = verify_webhook_signature(request)
         
         if event['type'] == 'payment_intent.succeeded':
-            intent = event['data']['object']
+            # Hand the work to a background worker so Stripe gets its 200
+            # in milliseconds, however slow fulfillment is
+            enqueue("stripe.fulfill", {
+                "intent_id": event['data']['object']['id'],
+                "event_id": event['id'],
+            })
+        
+        return "Received", 200
+    
+    # Worker (Celery / RQ / SQS consumer):
+    
+    def fulfill(job):
+        # One transaction: the event id commits only with the fulfillment
+        with db.transaction() as cur:
+            # Serialise concurrent jobs for the same PaymentIntent
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (job['intent_id'],))
+            
+            # Stripe delivers at least once — skip events already handled
+            cur.execute(
+                "INSERT INTO processed_stripe_events (event_id) VALUES (%s) "
+                "ON CONFLICT DO NOTHING",
+                (job['event_id'],),
+            )
+            if cur.rowcount == 0:
+                return
+            
+            intent = stripe.PaymentIntent.retrieve(job['intent_id'])
             
             # Extract multi-currency info
             customer_country = intent.metadata.get('customer_country')
@@ -350,8 +449,6 @@ def show_webhook_example():
             
             # Fulfill order
             fulfill_order(intent.metadata['order_id'])
-        
-        return "Received", 200
     """)
 
 
@@ -362,9 +459,7 @@ def show_webhook_example():
 def main():
     """Run the complete multi-currency demo."""
     
-    print("\n" + "="*80)
-    print("GLOBESHOP LTD - MULTI-CURRENCY PAYMENT SETUP")
-    print("="*80)
+    print(_section("GLOBESHOP LTD - MULTI-CURRENCY PAYMENT SETUP"))
     print(f"\nMerchant: {MERCHANT_CONFIG['business_name']}")
     print(f"Location: {MERCHANT_CONFIG['location']}")
     print(f"Default Currency: {MERCHANT_CONFIG['default_currency'].upper()}")
@@ -373,8 +468,8 @@ def main():
     print("\n" + "-"*80)
     print("SUPPORTED CURRENCIES & MARKETS")
     print("-"*80)
-    for curr, info in SUPPORTED_CURRENCIES.items():
-        print(f"  {curr.upper()}: {info['country']} ({info['region']})")
+    for curr_label, country, region in CURRENCY_ROWS:
+        print(f"  {curr_label}: {country} ({region})")
     
     # Part 2: Demonstrate multi-currency charges
     print("\n" + "-"*80)
@@ -389,16 +484,20 @@ def main():
         {"order_id": "ORDER_005", "amount_gbp": 20, "country": "UK"},
     ]
     
-    results = []
-    for scenario in test_scenarios:
+    # Each scenario is an independent PaymentIntent round-trip — create them
+    # concurrently so the demo waits roughly one RTT instead of one per order.
+    with ThreadPoolExecutor(max_workers=len(test_scenarios)) as executor:
+        results = list(executor.map(
+            lambda scenario: create_multi_currency_payment(
+                order_id=scenario['order_id'],
+                amount_gbp=scenario['amount_gbp'],
+                customer_country=scenario['country']
+            ),
+            test_scenarios,
+        ))
+    
+    for scenario, result in zip(test_scenarios, results):
         print(f"\nScenario: {scenario['order_id']} from {scenario['country']}")
-        result = create_multi_currency_payment(
-            order_id=scenario['order_id'],
-            amount_gbp=scenario['amount_gbp'],
-            customer_country=scenario['country']
-        )
-        results.append(result)
-        
         print(f"  Amount in GBP: £{result['base_amount_gbp']}")
         print(f"  Customer currency: {result['payment_currency'].upper()}")
         print(f"  Amount charged: {result['payment_currency'].upper()}{result['payment_amount']}")
@@ -418,9 +517,7 @@ def main():
     show_webhook_example()
     
     # Summary
-    print("\n" + "="*80)
-    print("TAM SUMMARY FOR GLOBESHOP")
-    print("="*80)
+    print(_section("TAM SUMMARY FOR GLOBESHOP"))
     print("""
     What we've covered:
     
@@ -461,6 +558,6 @@ def main():
 
 if __name__ == "__main__":
     results = main()
-    print("\n" + "="*80)
+    print("\n" + SEP)
     print(f"Completed {len([r for r in results if r['success']])} successful charges")
-    print("="*80 + "\n")
+    print(SEP + "\n")
@@ -12,14 +12,16 @@ Demonstrates:
 """
 
 import json
-from collections import defaultdict, Counter
+import sys
 from datetime import datetime, timedelta
+from itertools import islice
+from types import MappingProxyType
 
 # ============================================================================
 # PART 1: SIGMA SQL QUERIES (to run in Stripe Dashboard)
 # ============================================================================
 
-SIGMA_QUERIES = {
+_RAW_SIGMA_QUERIES = {
     "query_1_decline_breakdown": """
     SELECT
       charge.status,
@@ -28,7 +30,7 @@ SIGMA_QUERIES = {
       ROUND(100.0 * COUNT(*) / SUM(COUNT(*)) OVER (), 2) as percentage
     FROM charges
     WHERE created >= CURRENT_TIMESTAMP() - INTERVAL 30 DAY
-      AND status != 'succeeded'
+      AND status = 'failed'
     GROUP BY charge.status, charge.failure_code
     ORDER BY count DESC
     """,
@@ -41,7 +43,7 @@ SIGMA_QUERIES = {
       ROUND(100.0 * COUNT(*) / SUM(COUNT(*)) OVER (PARTITION BY card.brand), 2) as percentage_by_brand
     FROM charges
     WHERE created >= CURRENT_TIMESTAMP() - INTERVAL 30 DAY
-      AND status != 'succeeded'
+      AND status = 'failed'
     GROUP BY card.brand, charge.failure_code
     ORDER BY card.brand, count DESC
     """,
@@ -54,30 +56,46 @@ SIGMA_QUERIES = {
       ROUND(100.0 * COUNT(*) / SUM(COUNT(*)) OVER (PARTITION BY billing_details.address.country), 2) as percentage
     FROM charges
     WHERE created >= CURRENT_TIMESTAMP() - INTERVAL 30 DAY
-      AND status != 'succeeded'
+      AND status = 'failed'
     GROUP BY billing_details.address.country, charge.failure_code
     ORDER BY count DESC
     """,
     
     "query_4_by_amount_range": """
+    WITH declines AS (
+      SELECT
+        width_bucket(amount, ARRAY[5000, 10000, 50000]) as bucket,
+        charge.failure_code
+      FROM charges
+      WHERE created >= CURRENT_TIMESTAMP() - INTERVAL 30 DAY
+        AND status = 'failed'
+    )
     SELECT
-      CASE
-        WHEN amount < 5000 THEN '< €50'
-        WHEN amount < 10000 THEN '€50-€100'
-        WHEN amount < 50000 THEN '€100-€500'
+      CASE bucket
+        WHEN 0 THEN '< €50'
+        WHEN 1 THEN '€50-€100'
+        WHEN 2 THEN '€100-€500'
         ELSE '> €500'
       END as amount_range,
-      charge.failure_code,
+      failure_code,
       COUNT(*) as count,
       ROUND(100.0 * COUNT(*) / SUM(COUNT(*)) OVER (), 2) as percentage
-    FROM charges
-    WHERE created >= CURRENT_TIMESTAMP() - INTERVAL 30 DAY
-      AND status != 'succeeded'
-    GROUP BY amount_range, charge.failure_code
-    ORDER BY amount_range, count DESC
+    FROM declines
+    GROUP BY bucket, failure_code
+    ORDER BY bucket, count DESC
     """,
 }
 
+
+def _compact(query):
+    """Collapse a query's indentation and line breaks into single spaces."""
+    return " ".join(query.split())
+
+
+# Compacted once at import — nothing is re-stripped per use, and each
+# query is sent without its source indentation.
+SIGMA_QUERIES = {name: _compact(query) for name, query in _RAW_SIGMA_QUERIES.items()}
+
 # ============================================================================
 # PART 2: SIMULATED SIGMA RESULTS (based on typical patterns)
 # ============================================================================
@@ -157,6 +175,70 @@ SIMULATED_DECLINE_DATA = {
     }
 }
 
+def _freeze_rows(rows):
+    """Rows as a tuple of read-only mappings."""
+    return tuple(MappingProxyType(row) for row in rows)
+
+
+# Read-only all the way down — mappings, row lists and rows — so the views
+# derived from it below can't go stale
+SIMULATED_DECLINE_DATA = MappingProxyType({
+    section: (MappingProxyType({key: _freeze_rows(rows) for key, rows in groups.items()})
+              if isinstance(groups, dict) else _freeze_rows(groups))
+    for section, groups in SIMULATED_DECLINE_DATA.items()
+})
+
+
+def _to_columns(rows):
+    """
+    Split result rows into parallel (failure_code, label, count, percentage)
+    tuples — label is the upper-cased code, built once for display.
+    """
+    return (
+        tuple(row["failure_code"] for row in rows),
+        tuple(row["failure_code"].upper() for row in rows),
+        tuple(row["count"] for row in rows),
+        tuple(row["percentage"] for row in rows),
+    )
+
+
+# Column-oriented view of the results above — each group becomes parallel
+# tuples, so totals are a plain sum() over ints instead of a dict lookup per row
+DECLINE_COLUMNS = {
+    "decline_breakdown": _to_columns(SIMULATED_DECLINE_DATA["decline_breakdown"]),
+    **{
+        section: {group: _to_columns(rows) for group, rows in SIMULATED_DECLINE_DATA[section].items()}
+        for section in ("by_card_brand", "by_geography", "by_amount")
+    },
+}
+
+# Totals never change at runtime, so they're summed once here
+TOTAL_DECLINES = sum(DECLINE_COLUMNS["decline_breakdown"][2])
+GROUP_TOTALS = {
+    section: {group: sum(counts) for group, (codes, labels, counts, percentages) in groups.items()}
+    for section, groups in DECLINE_COLUMNS.items()
+    if section != "decline_breakdown"
+}
+
+
+def to_columnar(data=SIMULATED_DECLINE_DATA):
+    """
+    Flatten the per-group breakdowns into one column-major dict, ready for
+    pandas.DataFrame(...) or pyarrow.Table.from_pydict(...) without a
+    transpose. `group` is "<section>:<key>", e.g. "by_geography:PL".
+    """
+    columnar = {"group": [], "failure_code": [], "count": [], "percentage": []}
+    for section in ("by_card_brand", "by_geography", "by_amount"):
+        for key, rows in data[section].items():
+            group = f"{section}:{key}"
+            for row in rows:
+                columnar["group"].append(group)
+                columnar["failure_code"].append(row["failure_code"])
+                columnar["count"].append(row["count"])
+                columnar["percentage"].append(row["percentage"])
+    return columnar
+
+
 # ============================================================================
 # PART 3: DECLINE CLASSIFICATION & ANALYSIS
 # ============================================================================
@@ -184,105 +266,115 @@ DECLINE_CLASSIFICATION = {
     },
 }
 
+# Frozen like the simulated data, since CODE_TO_CATEGORY is derived from it
+DECLINE_CLASSIFICATION = MappingProxyType({
+    category: MappingProxyType(codes) for category, codes in DECLINE_CLASSIFICATION.items()
+})
+
+# Inverted lookup: failure code → category, for O(1) classification
+CODE_TO_CATEGORY = {
+    code: category
+    for category, codes in DECLINE_CLASSIFICATION.items()
+    for code in codes
+}
+
 # ============================================================================
 # PART 4: ANALYSIS FUNCTIONS
 # ============================================================================
 
 def classify_decline(failure_code):
     """Classify a decline code into category."""
-    for category, codes in DECLINE_CLASSIFICATION.items():
-        if failure_code in codes:
-            return category
-    return "UNKNOWN"
+    return CODE_TO_CATEGORY.get(failure_code, "UNKNOWN")
+
+# One failure-code line of a per-group breakdown, bound once at import
+_GROUP_ROW = "  • {:30s} {:3d} ({:5.1f}%)".format
+
 
 def analyze_decline_patterns():
     """Analyze all decline patterns and identify root cause."""
+    out = []
     
-    print("\n" + "="*80)
-    print("STRIPE SIGMA DECLINE ANALYSIS — PAYFLOW ANALYTICS")
-    print("="*80)
+    out.append("\n" + "="*80)
+    out.append("STRIPE SIGMA DECLINE ANALYSIS — PAYFLOW ANALYTICS")
+    out.append("="*80)
     
-    print(f"\nAnalysis Period: Last 30 days")
-    print(f"Analysis Date: {datetime.now().strftime('%Y-%m-%d %H:%M UTC')}")
+    out.append(f"\nAnalysis Period: Last 30 days")
+    out.append(f"Analysis Date: {datetime.now().strftime('%Y-%m-%d %H:%M UTC')}")
     
     # ========================================================================
     # 1. OVERALL DECLINE BREAKDOWN
     # ========================================================================
     
-    print("\n" + "-"*80)
-    print("1. OVERALL DECLINE BREAKDOWN")
-    print("-"*80)
+    out.append("\n" + "-"*80)
+    out.append("1. OVERALL DECLINE BREAKDOWN")
+    out.append("-"*80)
     
-    total_declines = sum(item["count"] for item in SIMULATED_DECLINE_DATA["decline_breakdown"])
+    codes, labels, counts, percentages = DECLINE_COLUMNS["decline_breakdown"]
     
-    print(f"\nTotal Declined Charges: {total_declines}")
-    print(f"Approximate Decline Rate: 3.2% (based on ~50k monthly volume)")
-    print("\nTop Decline Codes:")
+    out.append(f"\nTotal Declined Charges: {TOTAL_DECLINES}")
+    out.append(f"Approximate Decline Rate: 3.2% (based on ~50k monthly volume)")
+    out.append("\nTop Decline Codes:")
     
-    for item in SIMULATED_DECLINE_DATA["decline_breakdown"][:6]:
-        category = classify_decline(item["failure_code"])
-        description = DECLINE_CLASSIFICATION.get(category, {}).get(item["failure_code"], "Unknown")
-        print(f"  • {item['failure_code'].upper():30s} {item['count']:4d} ({item['percentage']:5.1f}%) — {category}")
-        print(f"      → {description}")
+    for code, label, count, percentage in zip(codes[:6], labels, counts, percentages):
+        category = classify_decline(code)
+        description = DECLINE_CLASSIFICATION.get(category, {}).get(code, "Unknown")
+        out.append(f"  • {label:30s} {count:4d} ({percentage:5.1f}%) — {category}\n      → {description}")
     
     # ========================================================================
     # 2. GEOGRAPHIC ANALYSIS
     # ========================================================================
     
-    print("\n" + "-"*80)
-    print("2. GEOGRAPHIC BREAKDOWN — Where Declines Are Happening")
-    print("-"*80)
+    out.append("\n" + "-"*80)
+    out.append("2. GEOGRAPHIC BREAKDOWN — Where Declines Are Happening")
+    out.append("-"*80)
     
-    for country, declines in SIMULATED_DECLINE_DATA["by_geography"].items():
-        country_total = sum(d["count"] for d in declines)
-        print(f"\n{country}: {country_total} declines")
-        for decline in declines[:3]:
-            print(f"  • {decline['failure_code'].upper():30s} {decline['count']:3d} ({decline['percentage']:5.1f}%)")
+    totals = GROUP_TOTALS["by_geography"]
+    for country, (codes, labels, counts, percentages) in DECLINE_COLUMNS["by_geography"].items():
+        out.append(f"\n{country}: {totals[country]} declines")
+        out.extend(map(_GROUP_ROW, labels[:3], counts, percentages))
     
-    print("\n⚠️  CRITICAL FINDING: Poland (PL) has 63% `insufficient_funds` declines")
-    print("   This is issuer-side, not fraud. Polish banks may be blocking high-value")
-    print("   international transactions or customers have low balances.")
+    out.append("\n⚠️  CRITICAL FINDING: Poland (PL) has 63% `insufficient_funds` declines")
+    out.append("   This is issuer-side, not fraud. Polish banks may be blocking high-value")
+    out.append("   international transactions or customers have low balances.")
     
     # ========================================================================
     # 3. CARD BRAND ANALYSIS
     # ========================================================================
     
-    print("\n" + "-"*80)
-    print("3. CARD BRAND BREAKDOWN")
-    print("-"*80)
+    out.append("\n" + "-"*80)
+    out.append("3. CARD BRAND BREAKDOWN")
+    out.append("-"*80)
     
-    for brand, declines in SIMULATED_DECLINE_DATA["by_card_brand"].items():
-        brand_total = sum(d["count"] for d in declines)
-        print(f"\n{brand.upper()}: {brand_total} declines")
-        for decline in declines[:3]:
-            print(f"  • {decline['failure_code'].upper():30s} {decline['count']:3d} ({decline['percentage']:5.1f}%)")
+    totals = GROUP_TOTALS["by_card_brand"]
+    for brand, (codes, labels, counts, percentages) in DECLINE_COLUMNS["by_card_brand"].items():
+        out.append(f"\n{brand.upper()}: {totals[brand]} declines")
+        out.extend(map(_GROUP_ROW, labels[:3], counts, percentages))
     
     # ========================================================================
     # 4. AMOUNT RANGE ANALYSIS
     # ========================================================================
     
-    print("\n" + "-"*80)
-    print("4. PAYMENT AMOUNT ANALYSIS")
-    print("-"*80)
+    out.append("\n" + "-"*80)
+    out.append("4. PAYMENT AMOUNT ANALYSIS")
+    out.append("-"*80)
     
-    for amount_range, declines in SIMULATED_DECLINE_DATA["by_amount"].items():
-        range_total = sum(d["count"] for d in declines)
-        print(f"\n{amount_range}: {range_total} declines")
-        for decline in declines[:2]:
-            print(f"  • {decline['failure_code'].upper():30s} {decline['count']:3d} ({decline['percentage']:5.1f}%)")
+    totals = GROUP_TOTALS["by_amount"]
+    for amount_range, (codes, labels, counts, percentages) in DECLINE_COLUMNS["by_amount"].items():
+        out.append(f"\n{amount_range}: {totals[amount_range]} declines")
+        out.extend(map(_GROUP_ROW, labels[:2], counts, percentages))
     
-    print("\n⚠️  FINDING: High-value (>€500) transactions have 65% `card_declined` rate")
-    print("   This suggests card network blocking for fraud prevention on large amounts.")
+    out.append("\n⚠️  FINDING: High-value (>€500) transactions have 65% `card_declined` rate")
+    out.append("   This suggests card network blocking for fraud prevention on large amounts.")
     
     # ========================================================================
     # 5. ROOT CAUSE HYPOTHESIS
     # ========================================================================
     
-    print("\n" + "="*80)
-    print("ROOT CAUSE ANALYSIS")
-    print("="*80)
+    out.append("\n" + "="*80)
+    out.append("ROOT CAUSE ANALYSIS")
+    out.append("="*80)
     
-    print("""
+    out.append("""
 Your 3.2% decline rate spike is driven by THREE distinct issues:
 
 1. ISSUER-SIDE BLOCKS (47% of declines) — Customers' banks rejecting charges
@@ -304,11 +396,11 @@ Your 3.2% decline rate spike is driven by THREE distinct issues:
     # 6. RECOMMENDATIONS
     # ========================================================================
     
-    print("-"*80)
-    print("RECOMMENDATIONS FOR PAYFLOW ANALYTICS")
-    print("-"*80)
+    out.append("-"*80)
+    out.append("RECOMMENDATIONS FOR PAYFLOW ANALYTICS")
+    out.append("-"*80)
     
-    print("""
+    out.append("""
 Tactical Actions (This Week):
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 1. FOR ISSUER BLOCKS (47% — "insufficient_funds" & "do_not_honor")
@@ -358,30 +450,33 @@ This would bring your decline rate from 3.2% back to 1.5-2.0% (normal range).
     # 7. HOW TO RUN THESE QUERIES IN SIGMA
     # ========================================================================
     
-    print("\n" + "="*80)
-    print("HOW TO RUN THESE QUERIES IN STRIPE SIGMA")
-    print("="*80)
+    out.append("\n" + "="*80)
+    out.append("HOW TO RUN THESE QUERIES IN STRIPE SIGMA")
+    out.append("="*80)
     
-    print("""
+    out.append("""
 1. Log into your Stripe Dashboard
 2. Go to Developers → Sigma
 3. Click "Create Query"
 4. Paste ONE of these SQL queries:
     """)
     
-    for name, query in list(SIGMA_QUERIES.items())[:2]:
-        print(f"\n--- Query: {name} ---")
-        print(query.strip()[:150] + "...\n")
+    for name, query in islice(SIGMA_QUERIES.items(), 2):
+        out.append(f"\n--- Query: {name} ---")
+        out.append(query[:150] + "...\n")
+    
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 def main():
     """Run the complete decline analysis."""
     analyze_decline_patterns()
     
-    print("\n" + "="*80)
-    print("ANALYSIS COMPLETE")
-    print("="*80)
-    print("""
+    out = []
+    out.append("\n" + "="*80)
+    out.append("ANALYSIS COMPLETE")
+    out.append("="*80)
+    out.append("""
 Next Steps:
 1. Review the recommendations above
 2. Implement smart retry logic for "processing_error" declines
@@ -391,6 +486,8 @@ Next Steps:
 
 Questions? Contact your TAM or Stripe support.
     """)
+    
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 if __name__ == "__main__":
@@ -13,18 +13,28 @@ Demonstrates:
 - Audit trail for idempotency key tracking
 """
 
+import functools
 import os
 import uuid
 import time
 import hashlib
 import random
+import requests
 import stripe
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# Keep-alive pool; the no-key comparison fires its requests concurrently.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+stripe.default_http_client = stripe.RequestsClient(timeout=30, session=_session, verify_ssl_certs=True)
+
 # ============================================================================
 # PART 1: IDEMPOTENCY KEY GENERATION STRATEGIES
 # ============================================================================
@@ -34,13 +44,29 @@ def generate_uuid_key():
     return str(uuid.uuid4())
 
 
+# Version 1 hashes with SHA-256 (truncated) and is the default, so keys that
+# are already stored or still being retried stay valid. Version 2 uses BLAKE2b,
+# which is faster on short inputs; changing versions changes every key, so opt
+# in (TRAVELBOOK_KEY_HASH_VERSION=2) only once no retry from the last 24h
+# (Stripe's idempotency window) can still be in flight.
+KEY_HASH_VERSION = int(os.getenv("TRAVELBOOK_KEY_HASH_VERSION", "1"))
+
+
+@functools.lru_cache(maxsize=4096)
+def _hash_composite_key(raw, version):
+    if version == 1:
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+
 def generate_composite_key(merchant_id, order_id, action):
     """
     Strategy 2: Composite key — deterministic, auditable.
     Same inputs always produce the same key, which is ideal for retries.
+    Memoised per hash version, so each retry of a booking skips re-hashing
+    and changing KEY_HASH_VERSION at runtime never serves a stale key.
     """
-    raw = f"{merchant_id}:{order_id}:{action}"
-    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+    return _hash_composite_key(f"{merchant_id}:{order_id}:{action}", KEY_HASH_VERSION)
 
 
 def demo_key_strategies():
@@ -78,6 +104,34 @@ def demo_key_strategies():
 # PART 2: SAFE PAYMENT CREATION WITH IDEMPOTENCY
 # ============================================================================
 
+# Set TRAVELBOOK_DRY_RUN=1 to run the demos without calling Stripe — each
+# payment is simulated locally, honouring idempotency keys as Stripe does
+DRY_RUN = bool(os.getenv("TRAVELBOOK_DRY_RUN"))
+_dry_run_payments = {}
+
+
+def _simulate_payment(amount, idempotency_key):
+    """Local stand-in for PaymentIntent.create, keyed on the idempotency key."""
+    original = _dry_run_payments.get(idempotency_key)
+    if original is None:
+        original = _dry_run_payments[idempotency_key] = {
+            "success": True,
+            "payment_intent_id": f"pi_mock_{uuid.uuid4().hex[:16]}",
+            "amount": amount,
+            "status": "requires_payment_method",
+            "idempotency_key": idempotency_key,
+        }
+    elif original["amount"] != amount:
+        return {
+            "success": False,
+            "error_type": "idempotency_collision",
+            "message": "Keys for idempotent requests can only be used with "
+                       "the same parameters they were first used with.",
+            "idempotency_key": idempotency_key,
+        }
+    return original
+
+
 def create_payment_safely(amount, currency, description, idempotency_key,
                           customer_email=None):
     """
@@ -85,6 +139,9 @@ def create_payment_safely(amount, currency, description, idempotency_key,
     If this exact key was used before (within 24h), Stripe returns
     the original response instead of creating a duplicate.
     """
+    if DRY_RUN:
+        return _simulate_payment(amount, idempotency_key)
+
     try:
         payment_intent = stripe.PaymentIntent.create(
             amount=amount,
@@ -185,28 +242,28 @@ def retry_with_backoff(func, max_retries=3, base_delay=1.0, **kwargs):
 
     for attempt in range(1, max_retries + 1):
         try:
-            start = time.time()
+            start = time.monotonic_ns()
             result = func(**kwargs)
-            elapsed = time.time() - start
+            elapsed_ms = (time.monotonic_ns() - start) // 1_000_000
 
             audit_log.append({
                 "attempt": attempt,
                 "status": "success",
-                "elapsed_ms": round(elapsed * 1000),
+                "elapsed_ms": elapsed_ms,
                 "payment_intent_id": result.get("payment_intent_id"),
             })
 
             return result, audit_log
 
         except stripe.error.APIConnectionError as e:
-            elapsed = time.time() - start
+            elapsed_ms = (time.monotonic_ns() - start) // 1_000_000
             # Exponential backoff with jitter
-            delay = base_delay * (2 ** (attempt - 1)) + random.uniform(0, 0.5)
+            delay = base_delay * (1 << (attempt - 1)) + random.random() * 0.5
 
             audit_log.append({
                 "attempt": attempt,
                 "status": "connection_error",
-                "elapsed_ms": round(elapsed * 1000),
+                "elapsed_ms": elapsed_ms,
                 "retry_delay_s": round(delay, 2),
                 "error": str(e),
             })
@@ -220,11 +277,11 @@ def retry_with_backoff(func, max_retries=3, base_delay=1.0, **kwargs):
                 return None, audit_log
 
         except stripe.error.StripeError as e:
-            elapsed = time.time() - start
+            elapsed_ms = (time.monotonic_ns() - start) // 1_000_000
             audit_log.append({
                 "attempt": attempt,
                 "status": "stripe_error",
-                "elapsed_ms": round(elapsed * 1000),
+                "elapsed_ms": elapsed_ms,
                 "error": str(e),
             })
             # Don't retry on non-connection errors (card_declined, etc.)
@@ -263,11 +320,10 @@ def demo_retry_logic():
         print(f"    Status: {result['status'] if result['success'] else 'ERROR'}")
 
     # Verify all returned the same PI
-    pi_ids = [r.get("payment_intent_id") for r in results if r.get("success")]
-    unique_pis = set(pi_ids)
+    pi_counts = Counter(r["payment_intent_id"] for r in results if r["success"])
     print(f"\n  Total API calls: {len(results)}")
-    print(f"  Unique PaymentIntents created: {len(unique_pis)}")
-    if len(unique_pis) == 1:
+    print(f"  Unique PaymentIntents created: {len(pi_counts)}")
+    if len(pi_counts) == 1:
         print("  ✓ All 3 requests returned the SAME PaymentIntent")
         print("  ✓ Customer charged exactly once — idempotency works!")
     else:
@@ -344,19 +400,24 @@ def demo_comparison():
     print("\n  --- WITHOUT idempotency keys (dangerous!) ---")
     print(f"  Simulating TravelBook's current retry logic for {booking_id}")
     print(f"  Amount: €{amount / 100:,.2f}")
-    no_key_results = []
-    for i in range(3):
-        result = create_payment_safely(
-            amount=amount,
-            currency="eur",
-            description=f"TravelBook: {booking_id} (NO idempotency)",
-            idempotency_key=generate_uuid_key(),  # new key each time = BAD
-        )
-        no_key_results.append(result)
+    # A fresh key per attempt makes the calls independent, so they can all be
+    # in flight at once (same-key requests must stay sequential — Stripe
+    # rejects concurrent use of one key)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        no_key_results = list(executor.map(
+            lambda _: create_payment_safely(
+                amount=amount,
+                currency="eur",
+                description=f"TravelBook: {booking_id} (NO idempotency)",
+                idempotency_key=generate_uuid_key(),  # new key each time = BAD
+            ),
+            range(3),
+        ))
+    for i, result in enumerate(no_key_results):
         print(f"    Attempt {i + 1}: PI={result.get('payment_intent_id', 'ERR')}")
 
-    no_key_pis = set(r.get("payment_intent_id") for r in no_key_results
-                     if r.get("success"))
+    no_key_pis = Counter(r["payment_intent_id"] for r in no_key_results
+                         if r["success"])
     print(f"\n  ✗ PaymentIntents created: {len(no_key_pis)}")
     print(f"  ✗ Customer would be charged {len(no_key_pis)}x = "
           f"€{amount / 100 * len(no_key_pis):,.2f}!")
@@ -377,8 +438,8 @@ def demo_comparison():
         key_results.append(result)
         print(f"    Attempt {i + 1}: PI={result.get('payment_intent_id', 'ERR')}")
 
-    key_pis = set(r.get("payment_intent_id") for r in key_results
-                  if r.get("success"))
+    key_pis = Counter(r["payment_intent_id"] for r in key_results
+                      if r["success"])
     print(f"\n  ✓ PaymentIntents created: {len(key_pis)}")
     print(f"  ✓ Customer charged exactly once = €{amount / 100:,.2f}")
     print(f"\n  💰 Money saved by idempotency: "
@@ -13,11 +13,17 @@ Demonstrates:
 - Compliance report generation with full audit trail
 """
 
+import json
 import os
+import threading
 import time
 import stripe
 import random
-from datetime import datetime, timedelta
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -27,11 +33,40 @@ RECALL_REFERENCE = "RECALL-2026-NB-PRO3000"
 PRODUCT_NAME = "NordBrew Pro 3000"
 PRODUCT_PRICE = 34900  # €349.00
 
+# Every completed sale of the recalled product, filtered server-side
+RECALL_SEARCH_QUERY = "metadata['product']:'nordbrew_pro_3000' AND status:'succeeded'"
+
 
 # ============================================================================
 # PART 1: CREATE TEST PAYMENTS (simulating NordBrew's recent sales)
 # ============================================================================
 
+# Confirming a card payment is the slowest call in the demo; 5 at a time
+TEST_PAYMENT_WORKERS = 5
+
+
+def _create_test_payment(i):
+    """Create and confirm one simulated NordBrew Pro 3000 sale."""
+    order_id = f"NB-{random.randint(10000, 99999)}"
+    customer_email = f"customer{i + 1}@example.com"
+
+    return stripe.PaymentIntent.create(
+        amount=PRODUCT_PRICE,
+        currency="eur",
+        description=f"{PRODUCT_NAME} — Order {order_id}",
+        metadata={
+            "product": "nordbrew_pro_3000",
+            "order_id": order_id,
+            "customer_email": customer_email,
+        },
+        confirm=True,
+        payment_method="pm_card_visa",
+        automatic_payment_methods={"enabled": True, "allow_redirects": "never"},
+        return_url=os.getenv("RETURN_URL", "https://example.com/success"),
+        idempotency_key=f"test-{order_id}",
+    )
+
+
 def create_test_payments(count=8):
     """
     Create test PaymentIntents simulating NordBrew Pro 3000 sales.
@@ -45,29 +80,16 @@ def create_test_payments(count=8):
           f"€{PRODUCT_PRICE / 100:.2f} each...")
     print("  (In production, these already exist from real purchases)\n")
 
-    payment_intents = []
-    for i in range(count):
-        order_id = f"NB-{random.randint(10000, 99999)}"
-        customer_email = f"customer{i + 1}@example.com"
-
-        pi = stripe.PaymentIntent.create(
-            amount=PRODUCT_PRICE,
-            currency="eur",
-            description=f"{PRODUCT_NAME} — Order {order_id}",
-            metadata={
-                "product": "nordbrew_pro_3000",
-                "order_id": order_id,
-                "customer_email": customer_email,
-            },
-            confirm=True,
-            payment_method="pm_card_visa",
-            automatic_payment_methods={"enabled": True, "allow_redirects": "never"},
-            return_url=os.getenv("RETURN_URL", "https://example.com/success"),
-        )
-
-        payment_intents.append(pi)
-        status_icon = "✓" if pi.status == "succeeded" else "○"
-        print(f"    {status_icon} {pi.id} | {order_id} | {customer_email}")
+    # Printed as each payment confirms; the list itself keeps creation order
+    payment_intents = [None] * count
+    with ThreadPoolExecutor(max_workers=TEST_PAYMENT_WORKERS) as executor:
+        futures = {executor.submit(_create_test_payment, i): i for i in range(count)}
+        for future in as_completed(futures):
+            pi = future.result()
+            payment_intents[futures[future]] = pi
+            status_icon = "✓" if pi.status == "succeeded" else "○"
+            print(f"    {status_icon} {pi.id} | {pi.metadata['order_id']} | "
+                  f"{pi.metadata['customer_email']}")
 
     print(f"\n  ✓ Created {len(payment_intents)} test payments")
 
@@ -89,10 +111,52 @@ def create_test_payments(count=8):
 # PART 2: DISCOVER ELIGIBLE PAYMENTS
 # ============================================================================
 
-def discover_eligible_payments(test_pi_ids=None):
+# Retrievals are independent round-trips; 10 in flight stays far below
+# Stripe's live-mode limit of 100 requests/second
+DISCOVERY_WORKERS = 10
+MAX_RATE_LIMIT_RETRIES = 5
+
+# One immutable record per refundable payment; field access is a tuple index
+# rather than a dict hash on every pass over the list
+EligiblePayment = namedtuple(
+    "EligiblePayment",
+    "pi_id charge_id amount already_refunded refundable order_id "
+    "customer_email description created",
+)
+
+
+def _fetch_pi(pi_id):
+    """Retrieve one PaymentIntent with its charge, backing off on 429s."""
+    for attempt in range(MAX_RATE_LIMIT_RETRIES):
+        try:
+            return stripe.PaymentIntent.retrieve(pi_id, expand=["latest_charge"])
+        except stripe.error.RateLimitError:
+            if attempt == MAX_RATE_LIMIT_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt + random.random())
+
+
+def discover_via_list(created_after_ts):
+    """
+    Yield recalled-product PaymentIntents created since created_after_ts.
+    List is read-after-write consistent (Search can lag ~1 minute) and still
+    returns 100 PIs with their charges per call; the product filter runs here.
+    """
+    payment_intents = stripe.PaymentIntent.list(
+        limit=100,
+        created={"gte": created_after_ts},
+        expand=["data.latest_charge"],
+    ).auto_paging_iter()
+    for pi in payment_intents:
+        if pi.metadata.get("product") == "nordbrew_pro_3000":
+            yield pi
+
+
+def discover_eligible_payments(test_pi_ids=None, created_after_ts=None):
     """
     Find all NordBrew Pro 3000 payments eligible for recall refund.
-    Uses metadata search to find the right product.
+    Uses metadata search to find the right product, or the List API when
+    created_after_ts is given and just-created payments must be included.
     """
     print("\n" + "=" * 70)
     print("PART 2: DISCOVERING ELIGIBLE PAYMENTS")
@@ -106,50 +170,64 @@ def discover_eligible_payments(test_pi_ids=None):
     skipped = []
 
     if test_pi_ids:
-        # Use our test payments
-        for pi_id in test_pi_ids:
-            pi = stripe.PaymentIntent.retrieve(pi_id, expand=["latest_charge"])
-            charge = pi.latest_charge
-
-            if pi.status != "succeeded":
-                skipped.append({
-                    "pi_id": pi.id,
-                    "reason": f"Status is '{pi.status}', not 'succeeded'",
-                })
-                continue
-
-            # Check existing refunds on this charge
-            already_refunded = charge.amount_refunded if charge else 0
-            refundable = pi.amount - already_refunded
+        # Use our test payments, fetched concurrently — Search can take up
+        # to a minute to index a freshly created payment
+        with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as executor:
+            payment_intents = list(executor.map(_fetch_pi, test_pi_ids))
+    elif created_after_ts is not None:
+        payment_intents = discover_via_list(created_after_ts)
+    else:
+        # Production: Search filters server-side, 100 payments per page
+        payment_intents = stripe.PaymentIntent.search(
+            query=RECALL_SEARCH_QUERY,
+            limit=100,
+            expand=["data.latest_charge"],
+        ).auto_paging_iter()
+
+    for pi in payment_intents:
+        charge = pi.latest_charge
+
+        # Search already filters on status; retrieve-by-ID and List cannot
+        if pi.status != "succeeded":
+            skipped.append({
+                "pi_id": pi.id,
+                "reason": f"Status is '{pi.status}', not 'succeeded'",
+            })
+            continue
 
-            if refundable <= 0:
-                skipped.append({
-                    "pi_id": pi.id,
-                    "reason": "Already fully refunded",
-                })
-                continue
+        # Check existing refunds on this charge (None if it never got one)
+        already_refunded = getattr(charge, "amount_refunded", 0)
+        charge_id = getattr(charge, "id", None)
+        refundable = pi.amount - already_refunded
 
-            eligible.append({
+        if refundable <= 0:
+            skipped.append({
                 "pi_id": pi.id,
-                "charge_id": charge.id if charge else None,
-                "amount": pi.amount,
-                "already_refunded": already_refunded,
-                "refundable": refundable,
-                "order_id": pi.metadata.get("order_id", "N/A"),
-                "customer_email": pi.metadata.get("customer_email", "N/A"),
-                "description": pi.description,
-                "created": datetime.fromtimestamp(pi.created),
+                "reason": "Already fully refunded",
             })
+            continue
+
+        eligible.append(EligiblePayment(
+            pi_id=pi.id,
+            charge_id=charge_id,
+            amount=pi.amount,
+            already_refunded=already_refunded,
+            refundable=refundable,
+            order_id=pi.metadata.get("order_id", "N/A"),
+            customer_email=pi.metadata.get("customer_email", "N/A"),
+            description=pi.description,
+            created=datetime.fromtimestamp(pi.created),
+        ))
 
     # Display results
     print(f"  Found {len(eligible)} eligible payments:\n")
     for i, p in enumerate(eligible, 1):
-        refund_type = "FULL" if p["already_refunded"] == 0 else "PARTIAL"
-        print(f"    {i}. {p['pi_id']}")
-        print(f"       Order: {p['order_id']} | {p['customer_email']}")
-        print(f"       Amount: €{p['amount'] / 100:.2f} | "
-              f"Already refunded: €{p['already_refunded'] / 100:.2f} | "
-              f"Refundable: €{p['refundable'] / 100:.2f} [{refund_type}]")
+        refund_type = "FULL" if p.already_refunded == 0 else "PARTIAL"
+        print(f"    {i}. {p.pi_id}")
+        print(f"       Order: {p.order_id} | {p.customer_email}")
+        print(f"       Amount: €{p.amount / 100:.2f} | "
+              f"Already refunded: €{p.already_refunded / 100:.2f} | "
+              f"Refundable: €{p.refundable / 100:.2f} [{refund_type}]")
 
     if skipped:
         print(f"\n  Skipped {len(skipped)} payments:")
@@ -169,9 +247,16 @@ def dry_run(eligible):
     print("PART 3: DRY RUN — REFUND PREVIEW (no money moves)")
     print("=" * 70)
 
-    total_refund = sum(p["refundable"] for p in eligible)
-    full_refunds = [p for p in eligible if p["already_refunded"] == 0]
-    partial_refunds = [p for p in eligible if p["already_refunded"] > 0]
+    # One pass over the list for all three aggregates
+    total_refund = 0
+    full_count = 0
+    partial_refunds = []
+    for p in eligible:
+        total_refund += p.refundable
+        if p.already_refunded == 0:
+            full_count += 1
+        else:
+            partial_refunds.append(p)
 
     print(f"\n  Recall Reference: {RECALL_REFERENCE}")
     print(f"  Product: {PRODUCT_NAME}")
@@ -180,7 +265,7 @@ def dry_run(eligible):
     print(f"  │  REFUND PREVIEW SUMMARY                     │")
     print(f"  ├─────────────────────────────────────────────┤")
     print(f"  │  Total payments to refund:  {len(eligible):>3}              │")
-    print(f"  │  Full refunds (€349.00):    {len(full_refunds):>3}              │")
+    print(f"  │  Full refunds (€349.00):    {full_count:>3}              │")
     print(f"  │  Partial refunds:           {len(partial_refunds):>3}              │")
     print(f"  │  Total refund amount:       €{total_refund / 100:>10,.2f}    │")
     print(f"  └─────────────────────────────────────────────┘")
@@ -188,9 +273,9 @@ def dry_run(eligible):
     if partial_refunds:
         print(f"\n  ⚠ Partial refunds (prior warranty claims detected):")
         for p in partial_refunds:
-            print(f"    {p['order_id']}: €{p['amount'] / 100:.2f} charged, "
-                  f"€{p['already_refunded'] / 100:.2f} already refunded → "
-                  f"€{p['refundable'] / 100:.2f} remaining to refund")
+            print(f"    {p.order_id}: €{p.amount / 100:.2f} charged, "
+                  f"€{p.already_refunded / 100:.2f} already refunded → "
+                  f"€{p.refundable / 100:.2f} remaining to refund")
 
     print(f"\n  → This is a DRY RUN. No refunds have been issued.")
     print(f"  → Run in EXECUTE mode to process all {len(eligible)} refunds.")
@@ -202,79 +287,232 @@ def dry_run(eligible):
 # PART 4: EXECUTE BULK REFUNDS
 # ============================================================================
 
-def execute_bulk_refunds(eligible):
-    """Process all refunds with error handling and audit trail."""
+# Stripe allows 100 requests/second in live mode and 25 in test mode
+REFUND_RATE_PER_SECOND = 100 if (stripe.api_key or "").startswith("sk_live") else 25
+REFUND_WORKERS = 8
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: up to `capacity` calls in a burst, refilled
+    at `rate` per second. acquire() blocks until a token is free.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_refund_bucket = TokenBucket(rate=REFUND_RATE_PER_SECOND, capacity=REFUND_RATE_PER_SECOND)
+
+
+# Shared across workers: doubles on each 429, decays back toward 1 on success
+_backoff_multiplier = 1.0
+_backoff_lock = threading.Lock()
+
+
+def _retry_after_seconds(value):
+    """
+    Parse a Retry-After header, which is either delay-seconds or an HTTP-date.
+    Returns None if it is missing or unparseable.
+    """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:  # HTTP-dates are always GMT
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _rate_limit_delay(error, attempt):
+    """
+    Seconds to wait after a 429: Retry-After as given if Stripe sent a usable
+    one, else capped exponential backoff scaled by the shared multiplier.
+    """
+    global _backoff_multiplier
+    with _backoff_lock:
+        _backoff_multiplier = min(_backoff_multiplier * 2, 8.0)
+        multiplier = _backoff_multiplier
+    retry_after = _retry_after_seconds((error.headers or {}).get("retry-after"))
+    if retry_after is not None:
+        return retry_after
+    return min(60, (2 ** attempt + random.uniform(0, 0.5)) * multiplier)
+
+
+def _create_refund(payment):
+    """Single Refund.create call for one eligible payment."""
+    return stripe.Refund.create(
+        payment_intent=payment.pi_id,
+        amount=payment.refundable,
+        reason="fraudulent",  # closest to product recall
+        metadata={
+            "recall_reference": RECALL_REFERENCE,
+            "product": "nordbrew_pro_3000",
+            "order_id": payment.order_id,
+            "customer_email": payment.customer_email,
+            "refund_type": ("full" if payment.already_refunded == 0
+                            else "partial_remainder"),
+        },
+        # Re-running after a crash replays the original refund instead of
+        # issuing a second one; the refund's own `created` is the timestamp
+        idempotency_key=f"{RECALL_REFERENCE}:{payment.pi_id}",
+    )
+
+
+def _submit_refund(payment):
+    """Create one recall refund, backing off and retrying on 429s."""
+    global _backoff_multiplier
+    for attempt in range(MAX_RATE_LIMIT_RETRIES):
+        _refund_bucket.acquire()
+        try:
+            refund = _create_refund(payment)
+        except stripe.error.RateLimitError as e:
+            if attempt == MAX_RATE_LIMIT_RETRIES - 1:
+                raise
+            time.sleep(_rate_limit_delay(e, attempt))
+            continue
+        with _backoff_lock:
+            _backoff_multiplier = max(1.0, _backoff_multiplier / 2)
+        return refund
+
+
+# Refunds are issued and checkpointed in chunks so a crash loses at most one
+# chunk of progress; the idempotency keys make re-issuing that chunk safe
+BATCH_SIZE = 25
+CHECKPOINT_PATH = ".recall_checkpoint.jsonl"
+CHECKPOINT_EXISTS_MESSAGE = (
+    f"{CHECKPOINT_PATH} exists from an interrupted run. Rerun with --resume, "
+    f"or remove it to start over."
+)
+
+
+def _load_checkpoint(path=CHECKPOINT_PATH):
+    """Succeeded-refund records written by an earlier, interrupted run."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def _flush_checkpoint(records, path=CHECKPOINT_PATH):
+    """Append succeeded-refund records to the checkpoint, one JSON per line."""
+    with open(path, "a") as fp:
+        for record in records:
+            fp.write(json.dumps(record) + "\n")
+
+
+def execute_bulk_refunds(eligible, resume=False):
+    """
+    Process all refunds with error handling and audit trail.
+    With resume=True, payments already in the checkpoint file are skipped and
+    their records are carried into the results. A fresh run refuses to start
+    while a checkpoint exists, and the checkpoint is only removed once every
+    refund has succeeded.
+    """
+    if not resume and os.path.exists(CHECKPOINT_PATH):
+        raise RuntimeError(CHECKPOINT_EXISTS_MESSAGE)
+
     print("\n" + "=" * 70)
     print("PART 4: EXECUTING BULK REFUNDS")
     print("=" * 70)
 
-    print(f"\n  Processing {len(eligible)} refunds...")
-    print(f"  Recall Reference: {RECALL_REFERENCE}\n")
-
+    resumed = _load_checkpoint() if resume else []
     results = {
-        "succeeded": [],
+        "succeeded": list(resumed),
         "failed": [],
+        "resumed": resumed,
     }
 
-    for i, payment in enumerate(eligible, 1):
-        try:
-            refund = stripe.Refund.create(
-                payment_intent=payment["pi_id"],
-                amount=payment["refundable"],
-                reason="fraudulent",  # closest to product recall
-                metadata={
-                    "recall_reference": RECALL_REFERENCE,
-                    "product": "nordbrew_pro_3000",
-                    "order_id": payment["order_id"],
-                    "customer_email": payment["customer_email"],
-                    "refund_type": ("full" if payment["already_refunded"] == 0
-                                    else "partial_remainder"),
-                    "processed_at": datetime.now().isoformat(),
-                },
-            )
+    if resume:
+        already_done = {r["pi_id"] for r in resumed}
+        eligible = [p for p in eligible if p.pi_id not in already_done]
+        print(f"\n  Resuming: {len(already_done)} refunds already in checkpoint")
 
-            refund_type = "FULL" if payment["already_refunded"] == 0 else "PARTIAL"
-            print(f"    [{i}/{len(eligible)}] ✓ {payment['order_id']} | "
-                  f"€{payment['refundable'] / 100:.2f} | {refund_type} | "
-                  f"Refund: {refund.id}")
-
-            results["succeeded"].append({
-                "order_id": payment["order_id"],
-                "pi_id": payment["pi_id"],
-                "refund_id": refund.id,
-                "amount": payment["refundable"],
-                "type": refund_type,
-                "customer_email": payment["customer_email"],
-                "status": refund.status,
-                "timestamp": datetime.now().isoformat(),
-            })
+    print(f"\n  Processing {len(eligible)} refunds...")
+    print(f"  Recall Reference: {RECALL_REFERENCE}\n")
 
-            # Small delay to respect rate limits on large batches
-            if i % 20 == 0:
-                print(f"    ... pausing briefly (rate limit safety) ...")
-                time.sleep(1)
-
-        except stripe.error.InvalidRequestError as e:
-            print(f"    [{i}/{len(eligible)}] ✗ {payment['order_id']} | "
-                  f"ERROR: {str(e)[:80]}")
-            results["failed"].append({
-                "order_id": payment["order_id"],
-                "pi_id": payment["pi_id"],
-                "error": str(e),
-                "customer_email": payment["customer_email"],
-                "timestamp": datetime.now().isoformat(),
-            })
+    # Workers only make the API calls; results are recorded here, on the
+    # main thread, in the order the refunds complete. Each chunk of
+    # BATCH_SIZE is checkpointed before the next one starts.
+    done = 0
+    with ThreadPoolExecutor(max_workers=REFUND_WORKERS) as executor:
+        for start in range(0, len(eligible), BATCH_SIZE):
+            chunk = eligible[start:start + BATCH_SIZE]
+            chunk_start = len(results["succeeded"])
+            batch_started_at = datetime.now().isoformat()
+            futures = {executor.submit(_submit_refund, p): p for p in chunk}
+
+            for future in as_completed(futures):
+                done += 1
+                payment = futures[future]
+                try:
+                    refund = future.result()
+
+                except stripe.error.InvalidRequestError as e:
+                    print(f"    [{done}/{len(eligible)}] ✗ {payment.order_id} | "
+                          f"ERROR: {str(e)[:80]}")
+                    results["failed"].append({
+                        "order_id": payment.order_id,
+                        "pi_id": payment.pi_id,
+                        "error": str(e),
+                        "customer_email": payment.customer_email,
+                        "timestamp": batch_started_at,
+                    })
+                    continue
+
+                except stripe.error.StripeError as e:
+                    print(f"    [{done}/{len(eligible)}] ✗ {payment.order_id} | "
+                          f"STRIPE ERROR: {str(e)[:80]}")
+                    results["failed"].append({
+                        "order_id": payment.order_id,
+                        "pi_id": payment.pi_id,
+                        "error": str(e),
+                        "customer_email": payment.customer_email,
+                        "timestamp": batch_started_at,
+                    })
+                    continue
+
+                refund_type = "FULL" if payment.already_refunded == 0 else "PARTIAL"
+                print(f"    [{done}/{len(eligible)}] ✓ {payment.order_id} | "
+                      f"€{payment.refundable / 100:.2f} | {refund_type} | "
+                      f"Refund: {refund.id}")
+
+                results["succeeded"].append({
+                    "order_id": payment.order_id,
+                    "pi_id": payment.pi_id,
+                    "refund_id": refund.id,
+                    "amount": payment.refundable,
+                    "type": refund_type,
+                    "customer_email": payment.customer_email,
+                    "status": refund.status,
+                    "timestamp": batch_started_at,
+                })
 
-        except stripe.error.StripeError as e:
-            print(f"    [{i}/{len(eligible)}] ✗ {payment['order_id']} | "
-                  f"STRIPE ERROR: {str(e)[:80]}")
-            results["failed"].append({
-                "order_id": payment["order_id"],
-                "pi_id": payment["pi_id"],
-                "error": str(e),
-                "customer_email": payment["customer_email"],
-                "timestamp": datetime.now().isoformat(),
-            })
+            _flush_checkpoint(results["succeeded"][chunk_start:])
+
+    if not results["failed"] and os.path.exists(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
 
     return results
 
@@ -283,58 +521,114 @@ def execute_bulk_refunds(eligible):
 # PART 5: COMPLIANCE REPORT
 # ============================================================================
 
+# Box-drawing characters are dropped when the report is piped to a file or CI log
+_NO_BOX = str.maketrans("", "", "┌┐└┘├┤│─")
+
+
+def _write_jsonl_report(generated, succeeded, failed, skipped,
+                        total_refunded, total_preview):
+    """
+    Write the audit trail as JSON Lines: one header record, then one record
+    per succeeded, failed and skipped payment. Returns the file path.
+    """
+    path = f"recall_{RECALL_REFERENCE}_{generated.strftime('%Y%m%d_%H%M%S')}.jsonl"
+    header = {
+        "record": "header",
+        "recall_reference": RECALL_REFERENCE,
+        "product": PRODUCT_NAME,
+        "generated_at": generated.isoformat(),
+        "total_refunded": total_refunded,
+        "expected_total": total_preview,
+        "verification_status": ("match" if total_refunded == total_preview
+                                else "mismatch"),
+    }
+    with open(path, "w") as fp:
+        fp.write(json.dumps(header) + "\n")
+        for kind, records in (("succeeded", succeeded), ("failed", failed),
+                              ("skipped", skipped)):
+            for record in records:
+                fp.write(json.dumps({"record": kind, **record}) + "\n")
+    return path
+
+
 def generate_compliance_report(results, eligible, skipped, total_preview):
     """Generate a full audit trail for legal compliance."""
-    print("\n" + "=" * 70)
-    print("PART 5: COMPLIANCE REPORT")
-    print("=" * 70)
+    # Refunds carried over from an interrupted run already show on their
+    # charges, so discovery skipped them and the preview left them out
+    resumed_ids = {r["pi_id"] for r in results["resumed"]}
+    eligible_ids = {p.pi_id for p in eligible}
+    total_preview += sum(r["amount"] for r in results["resumed"]
+                         if r["pi_id"] not in eligible_ids)
+    skipped = [s for s in skipped if s["pi_id"] not in resumed_ids]
 
     succeeded = results["succeeded"]
     failed = results["failed"]
     total_refunded = sum(r["amount"] for r in succeeded)
-
-    print(f"\n  ┌─────────────────────────────────────────────────────────┐")
-    print(f"  │  PRODUCT RECALL REFUND — COMPLIANCE REPORT             │")
-    print(f"  │  Reference: {RECALL_REFERENCE}              │")
-    print(f"  │  Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}                      │")
-    print(f"  ├─────────────────────────────────────────────────────────┤")
-    print(f"  │  Product:          {PRODUCT_NAME:<37} │")
-    print(f"  │  Unit Price:       €{PRODUCT_PRICE / 100:<36.2f} │")
-    print(f"  ├─────────────────────────────────────────────────────────┤")
-    print(f"  │  RESULTS                                               │")
-    print(f"  │  Refunds succeeded:  {len(succeeded):>3}                                │")
-    print(f"  │  Refunds failed:     {len(failed):>3}                                │")
-    print(f"  │  Payments skipped:   {len(skipped):>3}                                │")
-    print(f"  │  Total refunded:     €{total_refunded / 100:>10,.2f}                    │")
-    print(f"  │  Expected total:     €{total_preview / 100:>10,.2f}                    │")
     match = "✓ MATCH" if total_refunded == total_preview else "✗ MISMATCH"
-    print(f"  │  Verification:       {match:<35} │")
-    print(f"  └─────────────────────────────────────────────────────────┘")
+    generated = datetime.now()
+    jsonl_path = _write_jsonl_report(
+        generated, succeeded, failed, skipped, total_refunded, total_preview,
+    )
+
+    out = [
+        "\n" + "=" * 70,
+        "PART 5: COMPLIANCE REPORT",
+        "=" * 70,
+    ]
+
+    box = [
+        f"\n  ┌─────────────────────────────────────────────────────────┐",
+        f"  │  PRODUCT RECALL REFUND — COMPLIANCE REPORT             │",
+        f"  │  Reference: {RECALL_REFERENCE}              │",
+        f"  │  Generated: {generated.strftime('%Y-%m-%d %H:%M:%S')}                      │",
+        f"  ├─────────────────────────────────────────────────────────┤",
+        f"  │  Product:          {PRODUCT_NAME:<37} │",
+        f"  │  Unit Price:       €{PRODUCT_PRICE / 100:<36.2f} │",
+        f"  ├─────────────────────────────────────────────────────────┤",
+        f"  │  RESULTS                                               │",
+        f"  │  Refunds succeeded:  {len(succeeded):>3}                                │",
+        f"  │  Refunds failed:     {len(failed):>3}                                │",
+        f"  │  Payments skipped:   {len(skipped):>3}                                │",
+        f"  │  Total refunded:     €{total_refunded / 100:>10,.2f}                    │",
+        f"  │  Expected total:     €{total_preview / 100:>10,.2f}                    │",
+        f"  │  Verification:       {match:<35} │",
+        f"  └─────────────────────────────────────────────────────────┘",
+    ]
+    if not sys.stdout.isatty():
+        box = [line.translate(_NO_BOX).rstrip() for line in box]
+        box = [line for line in box if line.strip()]
+        box[0] = "\n" + box[0]
+    out.extend(box)
 
     # Detailed refund log
-    print(f"\n  --- Refund Detail Log ---\n")
+    out.append(f"\n  --- Refund Detail Log ---\n")
     for i, r in enumerate(succeeded, 1):
-        print(f"    {i}. Order: {r['order_id']}")
-        print(f"       PI:       {r['pi_id']}")
-        print(f"       Refund:   {r['refund_id']}")
-        print(f"       Amount:   €{r['amount'] / 100:.2f} ({r['type']})")
-        print(f"       Status:   {r['status']}")
-        print(f"       Customer: {r['customer_email']}")
-        print(f"       Time:     {r['timestamp']}")
-        print()
+        out.append(
+            f"    {i}. Order: {r['order_id']}\n"
+            f"       PI:       {r['pi_id']}\n"
+            f"       Refund:   {r['refund_id']}\n"
+            f"       Amount:   €{r['amount'] / 100:.2f} ({r['type']})\n"
+            f"       Status:   {r['status']}\n"
+            f"       Customer: {r['customer_email']}\n"
+            f"       Time:     {r['timestamp']}\n"
+        )
 
     if failed:
-        print(f"\n  --- Failed Refunds (requires manual review) ---\n")
+        out.append(f"\n  --- Failed Refunds (requires manual review) ---\n")
         for f_item in failed:
-            print(f"    ✗ Order: {f_item['order_id']}")
-            print(f"      PI:    {f_item['pi_id']}")
-            print(f"      Error: {f_item['error'][:100]}")
-            print()
+            out.append(
+                f"    ✗ Order: {f_item['order_id']}\n"
+                f"      PI:    {f_item['pi_id']}\n"
+                f"      Error: {f_item['error'][:100]}\n"
+            )
 
     if skipped:
-        print(f"  --- Skipped Payments ---\n")
+        out.append(f"  --- Skipped Payments ---\n")
         for s in skipped:
-            print(f"    — {s['pi_id']}: {s['reason']}")
+            out.append(f"    — {s['pi_id']}: {s['reason']}")
+
+    out.append(f"\n  Machine-readable report: {jsonl_path}")
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 # ============================================================================
@@ -360,7 +654,7 @@ def print_recommendations():
             "title": "2. Tag Refunds with Recall Metadata",
             "detail": (
                 "Every refund includes the recall reference number,\n"
-                "    order ID, and timestamp. This creates a searchable\n"
+                "    order ID, and refund type. This creates a searchable\n"
                 "    audit trail for legal and compliance teams."
             ),
         },
@@ -376,8 +670,8 @@ def print_recommendations():
             "title": "4. Rate Limit Safety for Large Batches",
             "detail": (
                 "Stripe's API allows 100 requests/second in live mode.\n"
-                "    For 147 refunds, add a small pause every 20 requests.\n"
-                "    For 1,000+ refunds, use exponential backoff on 429 errors."
+                "    Refunds run on a small worker pool behind a token bucket\n"
+                "    set to that rate, so large batches never trip the limit."
             ),
         },
         {
@@ -425,18 +719,29 @@ if __name__ == "__main__":
     print("╚══════════════════════════════════════════════════════════════════════╝")
     print()
 
-    # Part 1: Create test payments (simulating real purchases)
-    test_payments = create_test_payments(count=8)
-    test_pi_ids = [pi.id for pi in test_payments]
+    resume = "--resume" in sys.argv
+    if not resume and os.path.exists(CHECKPOINT_PATH):
+        sys.exit(f"  {CHECKPOINT_EXISTS_MESSAGE}")
+
+    if resume:
+        # Finish the interrupted run: no new test payments, and rediscover
+        # every recall payment through Search so the ones the checkpoint
+        # does not cover yet are picked up
+        print(f"  Resuming from {CHECKPOINT_PATH} — skipping Part 1")
+        eligible, skipped = discover_eligible_payments()
+    else:
+        # Part 1: Create test payments (simulating real purchases)
+        test_payments = create_test_payments(count=8)
+        test_pi_ids = [pi.id for pi in test_payments]
 
-    # Part 2: Discover eligible payments
-    eligible, skipped = discover_eligible_payments(test_pi_ids)
+        # Part 2: Discover eligible payments
+        eligible, skipped = discover_eligible_payments(test_pi_ids)
 
     # Part 3: Dry run preview
     total_preview = dry_run(eligible)
 
     # Part 4: Execute bulk refunds
-    results = execute_bulk_refunds(eligible)
+    results = execute_bulk_refunds(eligible, resume=resume)
 
     # Part 5: Compliance report
     generate_compliance_report(results, eligible, skipped, total_preview)